@@ -0,0 +1,183 @@
+import sys
+import os
+import json
+import time
+import inspect
+import traceback
+import numpy as np
+import random as rnd
+import pandas as pd
+from Queue import Empty
+from multiprocess import Pool, Process, Queue
+import INoDS_model as inods
+##################################################
+## Batch runs of INoDS. The job manifest is a json file with a list of jobs,
+## or a dictionary {"defaults": {...}, "jobs": [...]}. Each job is a dictionary
+## of arguments of INoDS_model.run_inods_sampler (edge_filename, health_filename,
+## output_filename and infection_type are required), plus an optional "name".
+## Relative file names are relative to the manifest.
+##################################################
+
+##arguments of run_inods_sampler used to preprocess the input data (see INoDS_model.read_input_data)
+input_arguments = ['edge_filename', 'health_filename', 'infection_type', 'complete_nodelist', 'edge_weights_to_binary', 'normalize_edge_weight', 'diagnosis_lag', 'is_network_dynamic', 'cache_dir']
+
+##############################################################################
+def read_manifest(manifest_filename, cache_dir=None):
+	r"""Returns the list of jobs in the manifest, with the defaults of run_inods_sampler
+	filled in. Jobs share cache_dir (default = inods_cache next to the manifest) unless
+	they set their own"""
+
+	with open(manifest_filename) as manifest_file: manifest = json.load(manifest_file)
+	defaults = {}
+	if isinstance(manifest, dict): defaults, manifest = manifest.get('defaults', {}), manifest['jobs']
+	folder = os.path.dirname(os.path.abspath(manifest_filename))
+	if cache_dir is None: cache_dir = os.path.join(folder, "inods_cache")
+
+	argspec = inspect.getargspec(inods.run_inods_sampler)
+	sampler_defaults = dict(zip(argspec.args[-len(argspec.defaults):], argspec.defaults))
+	sampler_defaults['cache_dir'] = cache_dir
+
+	job_list = []
+	for num, job in enumerate(manifest):
+		job = dict(sampler_defaults, **dict(defaults, **job))
+		for key in ['edge_filename', 'health_filename', 'output_filename']:
+			if key not in job: raise ValueError("Job %s of the manifest has no %s"%(num, key))
+			job[key] = os.path.normpath(os.path.join(folder, job[key]))
+		if 'infection_type' not in job: raise ValueError("Job %s of the manifest has no infection_type"%num)
+		unknown = set(job) - set(argspec.args) - set(['name'])
+		if unknown: raise ValueError("Job %s of the manifest has unknown arguments %s"%(num, sorted(unknown)))
+		job.setdefault('name', os.path.basename(job['output_filename']))
+		job_list.append(job)
+
+	return job_list
+
+##############################################################################
+def preprocess_worker(input_args):
+	r"""Preprocesses (and caches) the input data of one group of jobs. Returns the error
+	message if it fails"""
+
+	try: inods.read_input_data(*input_args)
+	except Exception: return traceback.format_exc()
+	return None
+
+##############################################################################
+def preprocess_inputs(job_list, max_cores):
+	r"""Preprocesses the input data once for each distinct set of input files and settings,
+	in parallel. Later jobs load it from the cache. Returns {job index: error message} of
+	jobs whose input data could not be read"""
+
+	groups = {}
+	for num, job in enumerate(job_list):
+		input_args = tuple(job[key] for key in input_arguments)
+		groups.setdefault(repr(input_args), (input_args, []))[1].append(num)
+	group_list = groups.values()
+	pool = Pool(processes=min(max_cores, len(group_list)))
+	try: errors = pool.map(preprocess_worker, [input_args for input_args, jobs in group_list], chunksize=1)
+	finally:
+		pool.close()
+		pool.join()
+
+	return {num: error for (input_args, jobs), error in zip(group_list, errors) if error is not None for num in jobs}
+
+##############################################################################
+def job_worker(queue, num, job):
+	r"""Runs one job. The printed output goes to output_filename_log.txt"""
+
+	sys.stdout = sys.stderr = open(job['output_filename'] + "_log.txt", "w", 1)
+	##forked processes inherit the random state of the parent
+	np.random.seed()
+	rnd.seed()
+	start = time.time()
+	kwargs = {key: job[key] for key in job if key != 'name'}
+	try: queue.put((num, inods.run_inods_sampler(**kwargs), None, time.time() - start))
+	except Exception:
+		traceback.print_exc()
+		queue.put((num, None, traceback.format_exc(), time.time() - start))
+
+##############################################################################
+def run_jobs(job_list, max_cores, verbose=True):
+	r"""Runs the jobs in separate processes, never using more than max_cores at a time.
+	Each job uses job['threads'] cores (capped at max_cores). Jobs are started in order of
+	the manifest, and a job that does not fit waits for running jobs to finish. Returns a
+	list of (results, error message, run time) per job"""
+
+	outcome = [None]*len(job_list)
+	if not job_list: return outcome
+	errors = preprocess_inputs(job_list, max_cores)
+	for num in errors: outcome[num] = (None, errors[num], 0.)
+	waiting = [num for num in xrange(len(job_list)) if outcome[num] is None]
+	queue = Queue()
+	running = {}
+	while waiting or running:
+		free_cores = max_cores - sum(cores for process, cores in running.values())
+		while waiting:
+			cores = min(max(int(job_list[waiting[0]]['threads']), 1), max_cores)
+			if cores > free_cores: break
+			num = waiting.pop(0)
+			process = Process(target=job_worker, args=(queue, num, job_list[num]))
+			process.start()
+			running[num] = (process, cores)
+			free_cores -= cores
+			if verbose: print ("started job"), job_list[num]['name']
+
+		try: finished = [queue.get(timeout=5)]
+		except Empty:
+			##jobs killed before they could report
+			finished = [(num, None, "Job process exited with code %s"%process.exitcode, np.nan) for num, (process, cores) in running.items() if process.exitcode not in (None, 0)]
+		for num, results, error, run_time in finished:
+			running.pop(num)[0].join()
+			outcome[num] = (results, error, run_time)
+			if verbose: print ("finished job"), job_list[num]['name'], ("" if error is None else "(failed)"), round(run_time, 1)
+
+	return outcome
+
+##############################################################################
+def summarize_results(job_list, outcome):
+	r"""Summary table (pandas DataFrame) with one row per job: parameter estimates (median
+	and 95% credible interval of beta and epsilon), log Bayes evidence (thermodynamic
+	integration and stepping-stone), proportion of times the asocial force dominates and
+	p-value of the null comparison"""
+
+	table = []
+	for job, (results, error, run_time) in zip(job_list, outcome):
+		row = {'name': job['name'], 'edge_filename': job['edge_filename'], 'health_filename': job['health_filename'],
+			'infection_type': job['infection_type'], 'diagnosis_lag': job['diagnosis_lag'], 'run_time': run_time,
+			'status': "failed" if error is not None else "done", 'error': "" if error is None else error.strip().splitlines()[-1]}
+		if results is not None:
+			if 'CI' in results:
+				for num, par in enumerate(['beta', 'epsilon']):
+					row[par], row[par + '_low'], row[par + '_high'] = results['CI'][num,1], results['CI'][num,0], results['CI'][num,2]
+				row['log_evidence'], row['log_evidence_error'] = results['log_evidence']
+				row['ss_log_evidence'], row['ss_log_evidence_error'] = results['stepping_stone_evidence']
+			if 'epsilon_dominant' in results: row['asocial_proportion'] = results['epsilon_dominant']
+			if 'p_value' in results: row['p_value'] = results['p_value']
+		table.append(row)
+
+	columns = ['name', 'status', 'edge_filename', 'health_filename', 'infection_type', 'diagnosis_lag', 'beta', 'beta_low', 'beta_high',
+		'epsilon', 'epsilon_low', 'epsilon_high', 'log_evidence', 'log_evidence_error', 'ss_log_evidence', 'ss_log_evidence_error',
+		'asocial_proportion', 'p_value', 'run_time', 'error']
+	return pd.DataFrame(table, columns=columns)
+
+##############################################################################
+def run_batch(manifest_filename, summary_filename=None, max_cores=1, cache_dir=None, verbose=True):
+	r"""Runs all jobs of the manifest and writes the summary table (see summarize_results)
+	to summary_filename (default = manifest filename with _summary.csv)"""
+
+	job_list = read_manifest(manifest_filename, cache_dir)
+	if summary_filename is None: summary_filename = os.path.splitext(manifest_filename)[0] + "_summary.csv"
+	outcome = run_jobs(job_list, max_cores, verbose)
+	df = summarize_results(job_list, outcome)
+	df.to_csv(summary_filename, index=False)
+	if verbose: print ("jobs done ="), (df['status']=="done").sum(), ("of"), len(df), ("summary written to"), summary_filename
+	return df
+
+######################################################################33
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Run INoDS on all jobs of a json manifest")
+	parser.add_argument("manifest")
+	parser.add_argument("--summary", default=None, help="summary table (csv)")
+	parser.add_argument("--cores", type=int, default=1, help="maximum number of cores used at a time")
+	parser.add_argument("--cache-dir", default=None, help="cache of the preprocessed input data")
+	args = parser.parse_args()
+	run_batch(args.manifest, args.summary, args.cores, args.cache_dir)
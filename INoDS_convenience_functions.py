@@ -2,10 +2,16 @@ import csv
 import networkx as nx
 import numpy as np
 import scipy.stats as ss
+import scipy.sparse as sparse
 from random import shuffle
 import matplotlib.pyplot as plt
 import pandas as pd
 from itertools import combinations
+import hashlib
+import os
+import shutil
+import time
+import json
 ###########################################################################
 def can_nodes_recover(infection_type):
 	r"""INoDS can handle the following infection model types = SI, SIR, SIS.
@@ -25,22 +31,32 @@ def can_nodes_recover(infection_type):
 def extract_maxtime(edge_filename, health_filename):
 	r""" Return min of maximum time across edge_filename and health_filename
 	"""
-	df = pd.read_csv(edge_filename)
-	
-	df.columns = df.columns.str.lower()
-	df.columns = [x.strip().replace('_', '') for x in df.columns]
-	df2 = pd.read_csv(health_filename)
-	df2.columns = df2.columns.str.lower()
-	df2.columns = [x.strip().replace('_', '') for x in df2.columns]
-	header= list(df)
-	if "timestep" not in header:return max(df2['timestep'])
-	else: return min(max(df['timestep']), max(df2['timestep']))
+	maxtime_health = read_maxtime(health_filename)
+	maxtime_edge = read_maxtime(edge_filename)
+	if maxtime_edge is None:return maxtime_health
+	else: return min(maxtime_edge, maxtime_health)
 
 #################################################################################
-def create_dynamic_network(edge_filename, complete_nodelist, edge_weights_to_binary, normalize_edge_weight, is_network_dynamic, time_max):
+def read_maxtime(filename):
+	r""" Maximum of the timestep column of filename (None if there is no timestep column).
+	Only that column is parsed"""
+
+	header = pd.read_csv(filename, nrows=0).columns
+	header = [x.lower().strip().replace('_', '') for x in header]
+	if "timestep" not in header: return None
+	return pd.read_csv(filename, usecols=[header.index("timestep")]).iloc[:, 0].max()
 
+#################################################################################
+def create_dynamic_network(edge_filename, complete_nodelist, edge_weights_to_binary, normalize_edge_weight, is_network_dynamic, time_max):
+	r""" Reads the edge list and returns (G, nodelist). G is a dictionary with key = timestep
+	and value = sparse (nodes x nodes) csr adjacency matrix of edge weights, with rows and
+	columns ordered as in nodelist. The edge list is sorted by timestep once and node ids 
+	are converted to row positions once. If the network is static, all timesteps share
+	the same matrix"""
 	
+	start = time.time()
 	df = pd.read_csv(edge_filename)
+	start = record_stage("file_load", start)
 	df.columns = df.columns.str.lower()
 	header = list(df)
 	
@@ -60,11 +76,7 @@ def create_dynamic_network(edge_filename, complete_nodelist, edge_weights_to_bin
 	if not is_network_dynamic:
 		if "timestep" in header:
 			raise ValueError("Network dynamic set as False but the infection data has timesteps!")
-		n_edges = len(df.index)
-		timelist = [[num]*n_edges for num in xrange(time_max+1)]
-		timelist = [val for sublist in timelist for val in sublist]
-		df=pd.concat([df]*(time_max+1), ignore_index=True)
-		df['timestep']=timelist
+		df['timestep'] = 0
 
 	if edge_weights_to_binary:df['weight']=1
 	
@@ -73,37 +85,91 @@ def create_dynamic_network(edge_filename, complete_nodelist, edge_weights_to_bin
 	if not edge_weights_to_binary and normalize_edge_weight:
 		## If the user asks for edge weight normalization, then calculate total edge weights
 		## at each time step
-		#print ("before converting"), min(df['weight']), max(df['weight'])
 		max_edgewt = max(df['weight'])/1.
 		df['weight'] = df["weight"]/max_edgewt
-		#print ("max weight"), max_edgewt, min(df['weight']), max(df['weight'])
-		
 
-	
+	##node id -> row position
+	n_edges = len(df.index)
+	node_code, node_label = pd.factorize(np.concatenate([df['node1'].values, df['node2'].values]))
+	nodelist = [str(node) for node in node_label]
+	if complete_nodelist is not None:
+		listed_nodes = set(nodelist)
+		nodelist += sorted(set(str(num) for num in complete_nodelist) - listed_nodes)
+	n_nodes = len(nodelist)
+
+	## one edge per node pair and timestep (the last row is kept), sorted by timestep
+	edges = pd.DataFrame({'timestep': df['timestep'].values, 'node1': np.minimum(node_code[:n_edges], node_code[n_edges:]), 
+		'node2': np.maximum(node_code[:n_edges], node_code[n_edges:]), 'weight': df['weight'].values})
+	edges = edges.drop_duplicates(['timestep', 'node1', 'node2'], keep='last').sort_values('timestep', kind='mergesort')
+
+	time_start, time_end = int(edges['timestep'].min()), int(edges['timestep'].max())
+	timestep = edges['timestep'].values - time_start
+	node1, node2, weight = edges['node1'].values, edges['node2'].values, edges['weight'].values.astype(np.float)
+	## all timesteps stacked as one (timesteps*nodes x nodes) matrix, both directions of each edge
+	loop = node1==node2
+	row = np.concatenate([timestep*n_nodes + node1, (timestep*n_nodes + node2)[~loop]])
+	col = np.concatenate([node2, node1[~loop]])
+	stack = sparse.csr_matrix((np.concatenate([weight, weight[~loop]]), (row, col)), shape=((time_end-time_start+1)*n_nodes, n_nodes))
+	G = return_network_slices(stack, n_nodes, time_start, time_end, is_network_dynamic, time_max)
+	record_stage("network_construction", start)
+
+	return G, nodelist
+
+##########################################################################
+def return_network_slices(stack, n_nodes, time_start, time_end, is_network_dynamic, time_max):
+	r"""Splits a stacked (timesteps*nodes x nodes) adjacency matrix of the timesteps from 
+	time_start to time_end into the network dictionary (key = timestep). If the network 
+	is static, all timesteps up to time_max share the matrix of time_start"""
+
 	G = {}
-	for time1 in range(df["timestep"].min(), df["timestep"].max()+1):  G[time1] = nx.Graph()
-	for time1 in G:
-		if complete_nodelist is not None:
-			complete_nodelist = [str(num) for num in complete_nodelist]
-			G[time1].add_nodes_from(complete_nodelist)
-		df_sub= df.loc[df['timestep'] == time1]
-		df_sub['node1'] = df_sub['node1'].astype(str)
-		df_sub['node2'] = df_sub['node2'].astype(str)
-		edge_list = list(zip(df_sub.node1, df_sub.node2))
-		G[time1].add_edges_from(edge_list)
-		edge_attr = dict(zip(zip(df_sub.node1, df_sub.node2), df_sub.weight))
-		nx.set_edge_attributes(G[time1],  edge_attr, 'weight')
-	
+	for time1 in range(time_start, time_end+1): G[time1] = stack[(time1-time_start)*n_nodes:(time1-time_start+1)*n_nodes]
+	if not is_network_dynamic: G = {time1: G[time_start] for time1 in xrange(time_max+1)}
+
 	return G
 
 ##########################################################################
-def extract_nodelist(H):
+def return_node_index(nodelist):
+	r"""Row position of each node in the infected strength arrays"""
+
+	return {node: num for num, node in enumerate(nodelist)}
+
+##########################################################################
+def network_to_adjacency(G, node_index):
+	r"""Converts a network dictionary of networkx graphs (e.g., user supplied null 
+	networks) into the format returned by create_dynamic_network, i.e., sparse 
+	(nodes x nodes) adjacency matrices of edge weights. Rows and columns
+	are ordered as in node_index. Returns a dictionary with key = time"""
+
+	n_nodes = len(node_index)
+	adjacency = {}
+	for time1 in G:
+		edges = [(node_index[str(node1)], node_index[str(node2)], wt) for node1, node2, wt in G[time1].edges(data="weight") if str(node1) in node_index and str(node2) in node_index]
+		row = [num1 for num1, num2, wt in edges] + [num2 for num1, num2, wt in edges if num1!=num2]
+		col = [num2 for num1, num2, wt in edges] + [num1 for num1, num2, wt in edges if num1!=num2]
+		weight = [wt for num1, num2, wt in edges] + [wt for num1, num2, wt in edges if num1!=num2]
+		adjacency[time1] = sparse.csr_matrix((weight, (row, col)), shape=(n_nodes, n_nodes))
+
+	return adjacency
+
+##########################################################################
+def stack_adjacency(adjacency, n_nodes, time_min, time_max):
+	r"""Stacks the adjacency matrices (e.g., a network G) of all time-points between time_min and time_max
+	into one sparse (timesteps*nodes x nodes) matrix. Row (time-time_min)*n_nodes + node
+	holds the edge weights of node at time. Missing time-points are left empty.
+	If all time-points share the same matrix (static network), that (nodes x nodes) 
+	matrix is returned instead"""
+
+	empty = sparse.csr_matrix((n_nodes, n_nodes))
+	adjacency_list = [adjacency.get(time1, empty) for time1 in range(time_min, time_max+1)]
+	if all(adj is adjacency_list[0] for adj in adjacency_list): return adjacency_list[0]
+	return sparse.vstack(adjacency_list, format="csr")
 
-	nodelist = [H[time].nodes() for time in H]
-	nodelist = [item for sublist in nodelist for item in sublist]
-	nodelist = list(set(nodelist))
+##########################################################################
+def create_infected_matrix(health_data):
+	r"""(nodes x timesteps) indicator matrix. Entry is one if the node is
+	reported (or imputed) sick at the time step in health_data"""
 
-	return nodelist
+	return (health_data['status']>0).astype(np.float)
 #######################################################################
 def check_edge_weights(G):
 	""" Code convergence is better if the edge weights are normalized
@@ -112,7 +178,7 @@ def check_edge_weights(G):
 	total_edge_wt = []
 	for time1 in G.keys():
 
-		total_wt = sum(nx.get_edge_attributes(G[time1],'weight').values())
+		total_wt = sparse.triu(G[time1]).sum()
 		total_wt = int(round(total_wt,1))
 		total_edge_wt.append(total_wt)
 	
@@ -189,250 +255,449 @@ def randomize_network2(G1):
 	return G, jaccard
 """
 ###################################################################
-def randomize_network(G1, complete_nodelist, network_dynamic = True):
+def randomize_network(G1, complete_nodelist, network_dynamic = True, seed=None):
 	
 	r""" Randomize edge connections of each network slice.
-	Also, set edge weight to mean.
+	Also, set edge weight to mean. seed sets the random stream of
+	the null network (default = drawn from np.random)
 	""" 
+	if seed is None: seed = np.random.randint(2**31-1)
+	random_state = np.random.RandomState(seed)
 	G2 = {}
 	if network_dynamic: 
-		for time in G1.keys():
-			G2[time] = nx.Graph()
-			if complete_nodelist is not None:
-				complete_nodelist = [str(num) for num in complete_nodelist]
-				G2[time].add_nodes_from(complete_nodelist)
-			else: G2[time].add_nodes_from(G1[time].nodes())
-			edge_size = len(G1[time].edges())
-			wtlist = [G1[time][node1][node2]["weight"] for node1, node2 in G1[time].edges()]
-			mean_wtlist = np.mean(wtlist)
-		
-
-			for num in xrange(len(G1[time].edges())): #for each edge in G1[time]
-				#select two random nodes from G2[time]
-				condition_met = False # skip over node pairs that already have an edge
-				counter=0
-				while not condition_met:
-					node1, node2 = np.random.choice(G2[time].nodes(), 2, replace=False)
-					if not (G2[time].has_edge(node1, node2) or G1[time].has_edge(node1, node2)): 
-						condition_met = True
-						G2[time].add_edge(node1, node2)
-						G2[time][node1][node2]["weight"] = mean_wtlist
-					
-					else:counter+=1
-					if counter > 4* edge_size and not (G2[time].has_edge(node1, node2)):
-					##Give up after 2*#edges attempts
-						condition_met=True
-						G2[time].add_edge(node1, node2)
-						G2[time][node1][node2]["weight"] = mean_wtlist
+		for time in sorted(G1.keys()): G2[time] = randomize_network_slice(G1[time], complete_nodelist is not None, random_state)
 
 	else:
 		init_time = min([time1 for time1 in G1])
-		G2[init_time] = nx.Graph()
-		if complete_nodelist is not None:
-				complete_nodelist = [str(num) for num in complete_nodelist]
-				G2[init_time].add_nodes_from(complete_nodelist)
-		else: G2[init_time].add_nodes_from(G1[init_time].nodes())
-		edge_size = len(G1[init_time].edges())
-		wtlist = [G1[init_time][node1][node2]["weight"] for node1, node2 in G1[init_time].edges()]
-		mean_wtlist = np.mean(wtlist)
-		
-
-		for num in xrange(len(G1[init_time].edges())): #for each edge in G1[time]
-			#select two random nodes from G2[time]
-			condition_met = False # skip over node pairs that already have an edge
-			counter=0
-			while not condition_met:
-				node1, node2 = np.random.choice(G2[init_time].nodes(), 2, replace=False)
-				if not (G2[init_time].has_edge(node1, node2) or G1[init_time].has_edge(node1, node2)): 
-					condition_met = True
-					G2[init_time].add_edge(node1, node2)
-					G2[init_time][node1][node2]["weight"] = mean_wtlist
-				
-				else:counter+=1
-				if counter > 4* edge_size and not (G2[init_time].has_edge(node1, node2)):
-				##Give up after 2*#edges attempts
-					condition_met=True
-					G2[init_time].add_edge(node1, node2)
-					G2[init_time][node1][node2]["weight"] = mean_wtlist
-
+		G2[init_time] = randomize_network_slice(G1[init_time], complete_nodelist is not None, random_state)
 		time_list = [time1 for time1 in G1 if time1 != init_time]
 		for time1 in time_list:
-			G2[time1] = G2[init_time].copy()
+			G2[time1] = G2[init_time]
 		
 	jaccard = calculate_mean_temporal_jaccard(G1, G2)
 
 	return G2, jaccard 
+#######################################################################
+def randomize_network_slice(G1, all_nodes, random_state):
+	r""" Randomize edge connections of one network slice (sparse adjacency matrix) and
+	set edge weight to mean. Edges are drawn between nodes with connections in G1 
+	(or between all nodes if all_nodes is True). All edges are drawn at once and node 
+	pairs are rejected by their edge key (= node1*n_nodes + node2, node1 < node2) if
+	they are already an edge of G1 or of the null slice"""
+
+	n_nodes = G1.shape[0]
+	##each edge once
+	old_key, wtlist = return_edge_key(G1)
+	edge_size = len(old_key)
+	if edge_size==0: return sparse.csr_matrix((n_nodes, n_nodes))
+	mean_wtlist = np.mean(wtlist)
+	if all_nodes: node_choice = np.arange(n_nodes)
+	else: node_choice = np.flatnonzero(np.diff(G1.indptr))
+	
+	new_key = np.zeros(0, dtype=np.int64)
+	for num in xrange(100):
+		n_missing = edge_size - len(new_key)
+		if n_missing==0 or len(node_choice)<2: break
+		node1 = node_choice[random_state.randint(len(node_choice), size=2*n_missing+10)]
+		node2 = node_choice[random_state.randint(len(node_choice), size=2*n_missing+10)]
+		pair = node1!=node2
+		key = np.minimum(node1, node2)[pair].astype(np.int64)*n_nodes + np.maximum(node1, node2)[pair]
+		##first draw of each node pair, in the order drawn
+		key = key[np.sort(np.unique(key, return_index=True)[1])]
+		key = key[~(np.in1d(key, old_key) | np.in1d(key, new_key))]
+		new_key = np.concatenate([new_key, key[:n_missing]])
+	
+	if len(new_key) < edge_size: 
+		## dense slice: pick from all the remaining node pairs. Edges of G1
+		## are used only if there are not enough node pairs without an edge
+		node1, node2 = np.triu_indices(len(node_choice), 1)
+		key = node_choice[node1].astype(np.int64)*n_nodes + node_choice[node2]
+		key = key[~np.in1d(key, new_key)]
+		key = np.concatenate([random_state.permutation(key[~np.in1d(key, old_key)]), random_state.permutation(key[np.in1d(key, old_key)])])
+		new_key = np.concatenate([new_key, key[:edge_size-len(new_key)]])
+
+	row = np.concatenate([new_key//n_nodes, new_key%n_nodes])
+	col = np.concatenate([new_key%n_nodes, new_key//n_nodes])
+	return sparse.csr_matrix((np.repeat(mean_wtlist, len(row)), (row, col)), shape=(n_nodes, n_nodes))
+#######################################################################
+def return_edge_key(G1):
+	r""" Edge key (= node1*n_nodes + node2, node1 <= node2) and weight of each 
+	edge of a network slice (sparse adjacency matrix)"""
+
+	n_nodes = G1.shape[0]
+	node1 = np.repeat(np.arange(n_nodes, dtype=np.int64), np.diff(G1.indptr))
+	upper = node1 <= G1.indices
+	
+	return node1[upper]*n_nodes + G1.indices[upper], G1.data[upper]
 #######################################################################		
-def stitch_health_data(health_data):
-	""" Fill in time steps with same infection status"""
-	for node in health_data.keys():
-		timelist = health_data[node].keys()
-		timelist = sorted(timelist)
-		for num in range(1, len(timelist)):
-			time2 = timelist[num]
-			time1 = timelist[num-1]
-			if health_data[node][time1]==health_data[node][time2]:
-				for step in range(time1+1, time2): health_data[node][step] = health_data[node][time2]
+def return_run_offsets(lengths):
+	r"""Position of each element inside its run, for consecutive runs of the given lengths 
+	(e.g., [2, 3] -> [0, 1, 0, 1, 2])"""
+
+	lengths = np.asarray(lengths, dtype=np.int64)
+	return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+#######################################################################
+def read_health_reports(health_filename, nodelist, time_max, chunk_size=2**20):
+	r"""Reads the health file (columns: node, timestep, diagnosis) in chunks of chunk_size rows. 
+	Returns the reports of the nodes in nodelist up to time_max as arrays of node position 
+	(in nodelist), timestep and diagnosis, sorted by node and timestep. If a node is reported 
+	more than once on a timestep, the last report in the file is kept"""
+
+	node_index = pd.Index(nodelist)
+	node, timestep, diagnosis = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+	try:
+		reader = pd.read_csv(health_filename, header=None, skiprows=1, usecols=[0, 1, 2], dtype={0: str, 1: np.int64, 2: np.int64}, 
+			na_filter=False, chunksize=chunk_size)
+		for chunk in reader:
+			pos = node_index.get_indexer(chunk[0].values)
+			keep = (pos>=0) & (chunk[1].values<=time_max)
+			node.append(pos[keep].astype(np.int32))
+			timestep.append(chunk[1].values[keep])
+			diagnosis.append(chunk[2].values[keep])
+	##no reports
+	except pd.errors.EmptyDataError: pass
+	node, timestep, diagnosis = np.concatenate(node), np.concatenate(timestep), np.concatenate(diagnosis)
+	
+	##sort on a single (node, timestep) key, keeping the reports of a node on a timestep in file 
+	## order. If it fits in int64, the key also holds the row number, and sorting the key values
+	## is much faster than a stable argsort
+	nrows = len(node)
+	time_min = timestep.min() if nrows>0 else 0
+	key = node.astype(np.int64)*(time_max-time_min+1) + timestep-time_min
+	if len(nodelist)*(time_max-time_min+1)*nrows < 2**63: order = np.sort(key*nrows + np.arange(nrows)) % nrows
+	else: order = np.argsort(key, kind='mergesort')
+	node, timestep, diagnosis = node[order], timestep[order], diagnosis[order]
+	last = np.ones(len(node), dtype=bool)
+	last[:-1] = (node[1:]!=node[:-1]) | (timestep[1:]!=timestep[:-1])
 	
+	return node[last], timestep[last], diagnosis[last]
+#######################################################################		
+def stitch_health_data(node, timestep, diagnosis):
+	""" Fill in time steps with same infection status. Reports are sorted arrays
+	(see sort_health_reports)"""
+
+	##number of missing time steps after each report that is followed by the same status
+	same = (node[1:]==node[:-1]) & (diagnosis[1:]==diagnosis[:-1])
+	gap = np.append(np.where(same, timestep[1:] - timestep[:-1] - 1, 0), 0)
+	offset = return_run_offsets(gap + 1)
 	
-	return health_data	
+	return np.repeat(node, gap + 1), np.repeat(timestep, gap + 1) + offset, np.repeat(diagnosis, gap + 1)
 #######################################################################
 def extract_health_data(health_filename, infection_type, nodelist, time_max, diagnosis_lag=False):
 
 	r"""node_health is a dictionary of dictionary. Primary key = node id.
 	Secondary key = 0/1. 0 (1) key stores chunk of days when the node is **known** to be healthy (infected).
-	 Dates stored as tuple of (start date, end date)"""
+	 Dates stored as tuple of (start date, end date). health_data is the read-only
+	 array form returned by return_health_arrays"""
 
-	health_data = {}
-	for node in nodelist: health_data[str(node)]={}
+	start = time.time()
+	reports = read_health_reports(health_filename, nodelist, time_max)
+	start = record_stage("file_load", start)
+	if diagnosis_lag: reports = stitch_health_data(*reports)
 
-	with open (health_filename, 'r') as csvfile:
-		fileread = csv.reader(csvfile, delimiter = ',')
-		next(fileread, None) #skip header
-		for row in fileread: 
-			node = str(row[0])
-			timestep = int(row[1])
-			diagnosis = int(row[2])
-			if node in nodelist and timestep<=time_max:health_data[node][timestep] = diagnosis
+	## chunks of time-periods when the nodes are reported uninfected (healthy_periods) and infected (sick_periods)
+	healthy_periods = select_healthy_time(reports, infection_type)
+	sick_periods = select_sick_times(reports)
 			
-	if diagnosis_lag: health_data = stitch_health_data(health_data)
+	health_data = return_health_arrays(reports, healthy_periods, sick_periods, nodelist, time_max)
+	node_health = return_node_health(health_data, nodelist)
+	record_stage("health_extraction", start)
+	return health_data, node_health
+##############################################################################
+def return_health_arrays(reports, healthy_periods, sick_periods, nodelist, time_max, time_min=0):
+	r""" Compact read-only form of the health data, nodes ordered as in nodelist.
+	health_data['status'] = (nodes x timesteps) matrix of diagnosis (-1 = no report), 
+	with the days in sick periods imputed as infected.
+	health_data['sick_periods'] (['healthy_periods']) = array of (node position, 
+	start date, end date) rows of node_health[node][1] ([0]), sorted by node and date.
+	health_data['reported'] = (nodes x 2) matrix, True if the node has any healthy 
+	(column 0) or sick (column 1) report"""
+
+	node, timestep, diagnosis = reports
+	status = np.full((len(nodelist), time_max-time_min+1), -1, dtype=np.int8)
+	inside = (timestep>=time_min) & (timestep<=time_max)
+	status[node[inside], timestep[inside]-time_min] = diagnosis[inside]
+
+	##impute the missing report of sick in health data
+	length = np.maximum(sick_periods[:, 2] - sick_periods[:, 1] + 1, 0)
+	sick_node = np.repeat(sick_periods[:, 0], length)
+	sick_day = np.repeat(sick_periods[:, 1], length) + return_run_offsets(length)
+	inside = (sick_day>=time_min) & (sick_day<=time_max)
+	status[sick_node[inside], sick_day[inside]-time_min] = 1
+	
+	reported = np.zeros((len(nodelist), 2), dtype=bool)
+	for key in [0, 1]: reported[node[diagnosis==key], key] = True
+	
+	health_arrays = {'status': status, 'sick_periods': sick_periods.astype(np.int), 'healthy_periods': healthy_periods.astype(np.int), 'reported': reported}
+	for arr in health_arrays.values(): arr.flags.writeable = False
+	return health_arrays
+##############################################################################
+def return_node_health(health_data, nodelist):
+	r""" node_health dictionary (see extract_health_data) from the health arrays"""
 
 	node_health = {}
-	for node in health_data.keys():
-		sick_list_node=[]
-		healthy_list_node=[]
-		node_health[node] = {}
-		## sort infection reported into infected (sick_list) and healthy (healthy_list) lists
-		for time1 in health_data[node].keys():
-			if health_data[node][time1]==1: sick_list_node.append(time1)
-			if health_data[node][time1]==0: healthy_list_node.append(time1)
-		
-		if len(healthy_list_node)>0:
-			healthy_list_node = sorted(healthy_list_node)
-			node_health[node][0] = select_healthy_time(healthy_list_node, node, health_data, infection_type)
-			
-				
-		
-		if len(sick_list_node)>0:
-			sick_list_node = sorted(sick_list_node)
-			node_health[node][1]= select_sick_times(sick_list_node, node, health_data) 
-
-		if node_health[node].has_key(1):		
-			for time1, time2 in node_health[node][1]:
-				##impute the missing report of sick in health data dictionary
-				for day in range(time1, time2+1): health_data[node][day]=1
-			
+	for node in nodelist: node_health[node] = {}
+	for key, periods in [(0, health_data['healthy_periods']), (1, health_data['sick_periods'])]:
+		for pos in np.flatnonzero(health_data['reported'][:, key]).tolist(): node_health[nodelist[pos]][key] = []
+		for pos, day1, day2 in periods.tolist(): node_health[nodelist[pos]][key].append((day1, day2))
+
+	return node_health
+##############################################################################
+def select_periods(reports, status, start_after, end_before):
+	r""" Select chunks of time-periods for which the nodes are reported with the status. A period
+	starts at a report with the status that is the first report of the node or follows a report in 
+	start_after, and ends at a report with the status that is the last report of the node or 
+	precedes a report in end_before. The k-th start of a node is paired with its k-th end. 
+	Returns an array of (node position, start date, end date) rows sorted by node and date"""
+
+	node, timestep, diagnosis = reports
+	first = np.ones(len(node), dtype=bool)
+	first[1:] = node[1:]!=node[:-1]
+	last = np.ones(len(node), dtype=bool)
+	last[:-1] = first[1:]
+	previous = np.insert(diagnosis[:-1], 0, -1)
+	following = np.append(diagnosis[1:], -1)
+
+	in_status = diagnosis==status
+	start = in_status & (first | (~first & np.in1d(previous, start_after)))
+	end = in_status & (last | (~last & np.in1d(following, end_before)))
 	
-	return health_data, node_health
+	##pair the starts and ends of each node in order
+	n_nodes = node.max()+1 if len(node)>0 else 0
+	nstart = np.bincount(node[start], minlength=n_nodes)
+	nend = np.bincount(node[end], minlength=n_nodes)
+	npairs = np.minimum(nstart, nend)
+	keep_start = return_run_offsets(nstart) < np.repeat(npairs, nstart)
+	keep_end = return_run_offsets(nend) < np.repeat(npairs, nend)
+	
+	return np.column_stack([node[start][keep_start], timestep[start][keep_start], timestep[end][keep_end]])
 ##############################################################################
-def select_healthy_time(healthy_list_node, node, health_data, infection_type):
+def select_healthy_time(reports, infection_type):
 
-	r""" Select chunks of time-periods (from healthy_list_node) for which the node
-	     is reported uninfected"""
+	r""" Select chunks of time-periods (from sorted health reports) for which the nodes
+	     are reported uninfected"""
 
-	healthy_times = []
-	
-	#if SIR type of infection
-	if infection_type[-1].lower()=='r':
-		#min date = if there was no report before the day
-		min_date = [time for time in healthy_list_node if len([val for key, val in health_data[node].items() if key<time])==0]
-		
-	else: 
-		#min date = if there is (any report before focal date AND the last report is sick) OR there is no report before the day
-		min_date = [time for time in healthy_list_node if (len([val for key, val in health_data[node].items() if key<time])>0 and health_data[node][max([key for key in health_data[node] if key < time])]==1) or len([val for key, val in health_data[node].items() if key<time])==0]
-		
+	#if SIR type of infection, min date = if there was no report before the day
+	if infection_type[-1].lower()=='r': start_after = []
+	#min date = if there is (any report before focal date AND the last report is sick) OR there is no report before the day
+	else: start_after = [1]
 	#max_date = if there is (any report after focal date AND the report is sick) OR there is no report after the day
-	max_date = [time for time in healthy_list_node if (len([val for key, val in health_data[node].items() if key> time])>0 and health_data[node][min([key for key in health_data[node] if key > time])]==1) or len([val for key, val in health_data[node].items() if key>time])==0]
-	
-	min_date = sorted(min_date)
-	max_date = sorted(max_date)
-	
-	for day1, day2 in zip(min_date, max_date): healthy_times.append((day1, day2))
-	return healthy_times
+	return select_periods(reports, 0, start_after, [1])
 	
 ############################################################################
-def select_sick_times(sick_list_node, node, health_data):
-	r""" Select chunks of time-periods (from sick_list_node) for which the node
-	     is reported sick"""
-
+def select_sick_times(reports):
+	r""" Select chunks of time-periods (from sorted health reports) for which the nodes
+	     are reported sick"""
 
-	sick_times = []
 	#min date = if there is (any report before the focal date AND the last report therin is healthy) OR there is no report before the day
-	min_date = [time for time in sick_list_node if (len([val for key, val in health_data[node].items() if key<time])>0 and health_data[node][max([key for key in health_data[node] if key < time])]==0) or len([val for key, val in health_data[node].items() if key<time])==0]
 	#max date = if there is (any report after the focal date AND the first report theirin is healthy) OR there is no report after the focal date
-	max_date = [time for time in sick_list_node if (len([val for key, val in health_data[node].items() if key> time])>0 and health_data[node][min([key for key in health_data[node] if key > time])]==0) or len([val for key, val in health_data[node].items() if key>time])==0]
+	return select_periods(reports, 1, [0], [0])
+
+#########################################################################
+def hash_file(filename, block_size=2**20):
+	r""" SHA-1 digest of the content of filename"""
+
+	digest = hashlib.sha1()
+	with open(filename, 'rb') as infile:
+		for block in iter(lambda: infile.read(block_size), b''): digest.update(block)
+	return digest.hexdigest()
+
+#########################################################################
+def return_cache_path(cache_dir, filenames, settings):
+	r""" Cache directory of the preprocessed data. The name is the hash of the content of 
+	the input files and of the preprocessing settings, so any change in either gives a 
+	new cache entry"""
+
+	key = repr(("inods-cache-3", [hash_file(filename) for filename in filenames], settings))
+	return os.path.join(cache_dir, hashlib.sha1(key).hexdigest())
+
+#########################################################################
+def save_cache(cache_path, arrays):
+	r""" Saves the dictionary of arrays as one .npy file per key in cache_path. The files
+	are written to a temporary directory that is renamed once complete, so an interrupted
+	run never leaves a partial cache entry"""
+
+	tmp_path = "%s.tmp%d" % (cache_path, os.getpid())
+	if not os.path.isdir(tmp_path): os.makedirs(tmp_path)
+	for key in arrays: np.save(os.path.join(tmp_path, key + ".npy"), arrays[key])
+	try: os.rename(tmp_path, cache_path)
+	##another run saved the same entry first
+	except OSError: shutil.rmtree(tmp_path)
+
+#########################################################################
+def load_cache(cache_path, mmap_mode='r'):
+	r""" Dictionary of the arrays saved in cache_path (None if there is no cache entry). 
+	The arrays are memory-mapped read-only, so only the parts that are used are read"""
+
+	if not os.path.isdir(cache_path): return None
+	return {filename[:-4]: np.load(os.path.join(cache_path, filename), mmap_mode=mmap_mode) for filename in os.listdir(cache_path) if filename.endswith(".npy")}
+
+#########################################################################
+## timing and likelihood counters of the current run (see start_instrumentation), 
+## None when not instrumented
+instrumentation = None
+## edges (seconds) of the likelihood latency histograms, four bins per decade
+latency_bins = 10**np.arange(-7, 3.01, 0.25)
+
+def start_instrumentation():
+	r""" Resets the instrumentation of the current process. Stage times are then added up 
+	by record_stage, and likelihood latencies by record_likelihood_calls"""
+
+	global instrumentation
+	instrumentation = {'start': time.time(), 'stages': [], 'likelihood': {}}
+	return instrumentation
+
+#########################################################################
+def record_stage(stage, start, end=None):
+	r""" Adds the time from start to end (default = now) to stage. Returns end, so 
+	consecutive stages can be chained"""
+
+	if end is None: end = time.time()
+	if instrumentation is None: return end
+	for entry in instrumentation['stages']:
+		if entry['stage'] == stage: break
+	else:
+		entry = {'stage': stage, 'seconds': 0., 'calls': 0}
+		instrumentation['stages'].append(entry)
+	entry['seconds'] += end - start
+	entry['calls'] += 1
+	return end
+
+#########################################################################
+def record_likelihood_calls(kind, latency):
+	r""" Adds the latencies (array of seconds per call) of likelihood calls of kind to 
+	the latency histogram (see latency_bins) of kind"""
+
+	if instrumentation is None or len(latency) == 0: return
+	latency = np.asarray(latency, dtype=float)
+	entry = instrumentation['likelihood'].setdefault(kind, {'calls': 0, 'seconds': 0., 'min_latency': np.inf, 'max_latency': 0., 
+		'histogram': np.zeros(len(latency_bins)-1, dtype=int)})
+	entry['calls'] += len(latency)
+	entry['seconds'] += latency.sum()
+	entry['min_latency'] = min(entry['min_latency'], latency.min())
+	entry['max_latency'] = max(entry['max_latency'], latency.max())
+	##latencies outside the bins are counted in the first and last bin
+	position = np.clip(np.searchsorted(latency_bins, latency, side='right')-1, 0, len(latency_bins)-2)
+	entry['histogram'] += np.bincount(position, minlength=len(latency_bins)-1)
+
+#########################################################################
+def write_instrumentation(filename, extra):
+	r""" Writes the instrumentation of the current run, and the dictionary extra 
+	(e.g. sampler statistics), as a json report to filename. Returns the report"""
+
+	report = {'total_seconds': time.time() - instrumentation['start'], 'stages': instrumentation['stages'], 'likelihood': {}}
+	for kind, entry in instrumentation['likelihood'].items():
+		report['likelihood'][kind] = {'calls': entry['calls'], 'seconds': entry['seconds'], 'mean_latency': entry['seconds']/entry['calls'],
+			'min_latency': entry['min_latency'], 'max_latency': entry['max_latency'],
+			'histogram': {'bin_edges': latency_bins.tolist(), 'counts': entry['histogram'].tolist()}}
+	report.update(extra)
+	with open(filename, "w") as outfile: json.dump(report, outfile, indent=1)
+	return report
+
+#########################################################################
+def return_contact_matrix(G_raw, n_nodes, n_times, time_min=0):
+	r"""Boolean (networks x nodes x timesteps) matrix, True if the node has any edge in the 
+	network on the timestep. Networks are ordered by key, timesteps start at time_min"""
+
+	contact = np.zeros((len(G_raw), n_nodes, n_times), dtype=bool)
+	for num, network in enumerate(sorted(G_raw)):
+		G = G_raw[network]
+		for time1 in G:
+			if time_min <= time1 < time_min+n_times: contact[num, :, time1-time_min] = np.diff(G[time1].indptr)>0
+
+	return contact
+
+#########################################################################
+def return_candidate_days(contact, node, first_day, last_day, time_min=0):
+	r"""For each case (node, first_day, last_day), the days between first_day and last_day
+	(inclusive) after a day with contact (see return_contact_matrix), or all the days if 
+	there is none. Returns the days as a padded (networks x cases x max days) array (-1 = 
+	padding) and the number of days as a (networks x cases) array"""
+
+	n_networks, n_times = contact.shape[0], contact.shape[2]
+	ndays = np.maximum(last_day - first_day + 1, 0)
+	case = np.repeat(np.arange(len(node)), ndays)
+	days = np.repeat(first_day, ndays) + return_run_offsets(ndays)
+	previous = days - 1 - time_min
+	inside = (previous>=0) & (previous<n_times)
+	has_contact = np.zeros((n_networks, len(days)), dtype=bool)
+	has_contact[:, inside] = contact[:, node[case[inside]], previous[inside]]
+
+	##cases without any contact day keep all the days
+	case_start = np.cumsum(ndays) - ndays
+	count = np.concatenate([np.zeros((n_networks, 1), dtype=np.int), np.cumsum(has_contact, axis=1)], axis=1)
+	ncontact = count[:, case_start+ndays] - count[:, case_start]
+	use = has_contact | (ncontact==0)[:, case]
 	
-	min_date = sorted(min_date)
-	max_date = sorted(max_date)
+	##position of each used day among the used days of its case
+	count = np.concatenate([np.zeros((n_networks, 1), dtype=np.int), np.cumsum(use, axis=1)], axis=1)
+	network_pos, day_pos = np.nonzero(use)
+	rank = count[network_pos, day_pos] - count[network_pos, case_start[case[day_pos]]]
+	candidate_ndays = np.where(ncontact==0, ndays, ncontact)
+	candidate_days = np.full((n_networks, len(node), candidate_ndays.max() if candidate_ndays.size>0 else 0), -1, dtype=np.int)
+	candidate_days[network_pos, case[day_pos], rank] = days[day_pos]
+
+	return candidate_days, candidate_ndays
+
+#########################################################################
+def search_healthy_periods(healthy_periods, node, day, side):
+	r"""For each (node, day), the row in healthy_periods of the healthy period of the node 
+	with the last end date before day (side = 'left') or the first end date after day 
+	(side = 'right'). Returns the rows and whether there is such a period"""
+
+	if len(healthy_periods)==0: return np.zeros(len(node), dtype=np.int), np.zeros(len(node), dtype=bool)
+	##one key per healthy period = node and end date
+	all_days = np.concatenate([healthy_periods[:, 2], day, [0]])
+	day_min, span = all_days.min(), all_days.max() - all_days.min() + 1
+	key = healthy_periods[:, 0].astype(np.int64)*span + healthy_periods[:, 2]-day_min
+	order = np.argsort(key, kind='mergesort')
+	pos = np.searchsorted(key[order], node.astype(np.int64)*span + day-day_min, side=side)
+	if side=='left': pos -= 1
+	found = (pos>=0) & (pos<len(key))
+	found[found] = healthy_periods[order[pos[found]], 0]==node[found]
 	
-	for day1, day2 in zip(min_date, max_date): sick_times.append((day1, day2))
-	return sick_times
+	return order[np.where(found, pos, 0)], found
 
 #########################################################################
-def return_contact_days_sick_nodes(node_health, seed_date, G_raw):
+def return_contact_days_sick_nodes(health_data, seed_date, G_raw, nodelist):
 	r"""If infection diagnosis is lagged, then true infection day is
-	inferred using infectious contact history of the focal node """
-
-	contact_daylist={key:{} for key in G_raw}
-	## select all nodes that were reported infected and sort
-	for node in sorted([node1 for node1 in node_health.keys() if node_health[node1].has_key(1)]):
-		## removing seed nodes
-		sick_days = [(time1, time2) for (time1, time2) in sorted(node_health[node][1]) if time1!= seed_date]
-		##for all time periods when the node was reported sick
-		for time1, time2 in sick_days:
-			#default day start
-			day_start =1
-			if node_health[node].has_key(0):
-				##choose all uninfected time-periods before the focal sick period
-				healthy_dates = [(healthy_day1, healthy_day2) for healthy_day1, healthy_day2 in node_health[node][0] if healthy_day2 < time1]
-				if len(healthy_dates)>0:
-					##choose the latest uninfected period
-					lower_limit, upper_limit = max(healthy_dates, key=lambda x:x[1])
-					##choose the last ever reported time-point of being uninfected
-					day_start = upper_limit
-
-			##contact_daylist is dictionary. Primary key = network type. Could be network hypothesis or null network
-			## secondary key (node1, time1, time2) indicated focal node and its infected time period
-			##values are the time-points when the node could have potentially contracted infection
-		
-			for network in G_raw:
-				#choose only those days where nodes has contact the previous day
-				
-				contact_daylist[network][(node, time1, time2)] =[day for day in range(day_start+1, time1+1) if (day-1) in G_raw[network] and node in G_raw[network][day-1].nodes() and G_raw[network][day-1].degree(node)>0]
-				##if there are no contacts then return the entire list
-				if len(contact_daylist[network][(node, time1, time2)])==0: 
-					contact_daylist[network][(node, time1, time2)] = [day for day in range(day_start+1, time1+1)]
-
-				
-	return contact_daylist
+	inferred using infectious contact history of the focal node. The candidate
+	infection days of a sick period are the days after the last healthy report that follow 
+	a day with contact. Format: contact_daylist['sick_cases'] = (node position, time1, time2) 
+	rows of the sick periods (except on the seed date), sorted by node id and date. 
+	contact_daylist['days'][network, case] = padded candidate days (-1 = padding), 
+	contact_daylist['ndays'][network, case] = number of candidate days. Networks are 
+	ordered by key in G_raw"""
+
+	sick_periods = health_data['sick_periods']
+	sick_periods = sick_periods[sick_periods[:, 1]!=seed_date]
+	## sort by node id (as string) and infection period
+	node_rank = np.argsort(np.argsort(np.array(nodelist)))
+	sick_periods = sick_periods[np.lexsort((sick_periods[:, 2], sick_periods[:, 1], node_rank[sick_periods[:, 0]]))]
+	node, time1 = sick_periods[:, 0], sick_periods[:, 1]
+
+	##the last ever reported time-point of being uninfected before the sick period (default 1)
+	healthy_periods = health_data['healthy_periods']
+	latest, found = search_healthy_periods(healthy_periods, node, time1, 'left')
+	day_start = np.where(found, healthy_periods[latest, 2] if len(healthy_periods)>0 else 1, 1)
+
+	contact = return_contact_matrix(G_raw, len(nodelist), health_data['status'].shape[1])
+	candidate_days, candidate_ndays = return_candidate_days(contact, node, day_start+1, time1)
+
+	return {'sick_cases': sick_periods, 'days': candidate_days, 'ndays': candidate_ndays}
 
 #########################################################################
-def return_potention_recovery_date(node_health, time_max):
+def return_potention_recovery_date(health_data, sick_cases, time_max):
 	r""" For SIR/SIS model. Returns the potential time-points of recovery for each 
-	infected focal node"""
+	infected focal node, as an array aligned with the sick_cases rows (node position, 
+	time1, time2), e.g. contact_daylist['sick_cases']"""
+	
+	##recovery date can be any time-point between the last report of node "infection" state to the the first 
+	## report of uninfection afterwards (or time_max of the study)
+	healthy_periods = health_data['healthy_periods']
+	first, found = search_healthy_periods(healthy_periods, sick_cases[:, 0], sick_cases[:, 1], 'right')
 	
-	recovery_daylist = {}
-	## select all nodes that were reported infected and sort
-	for node in sorted([node1 for node1 in node_health.keys() if node_health[node1].has_key(1)]):
-		## sort sick days for the focal node
-		sick_days = sorted(node_health[node][1])
-		for time1, time2 in sick_days:
-			if node_health[node].has_key(0):
-				##choose all uninfected time-periods after the focal sick period
-				healthy_dates = [(healthy_day1, healthy_day2) for healthy_day1, healthy_day2 in node_health[node][0] if healthy_day2 > time1]
-				
-				if len(healthy_dates)>0:
-					##choose the first report of uninfection
-					lower_limit, upper_limit = min(healthy_dates, key=lambda x:x[1])
-					recovery_date = lower_limit
-				else: recovery_date = time_max
-			else: recovery_date = time_max
-		        
-			##recovery date can be any time-point between the last report of node "infection" state to the the first 
-			## report of uninfection afterwards (or time_max of the study)
-			recovery_daylist[(node, time1, time2)] = recovery_date
-
-	return recovery_daylist
+	return np.where(found, healthy_periods[first, 1] if len(healthy_periods)>0 else time_max, time_max)
 ####################################################################################
 def find_seed_date(node_health):
 	r"""Find the first time-period where an infection was reported"""
@@ -464,16 +729,20 @@ def calculate_jaccard(g1, g2):
 def calculate_mean_temporal_jaccard(g1, g2):
 
 	jlist = []
+	##static networks share the same matrices across time-points
+	ratio_by_pair = {}
 	for time1 in g1:
-		edges1 = [tuple(sorted(num)) for num in g1[time1].edges()]
-		edges2 = [tuple(sorted(num)) for num in g2[time1].edges()]
-
-		w11 = len(list(set(edges1) & set(edges2)))
-		w10 = len(list(set(edges1) - set(edges2)))
-		w01 =  len(list(set(edges2) - set(edges1)))
-		if (w11+w10+w01)>0:ratio = w11/ (1.*(w11+w10+w01))
-		else:ratio=0
-		jlist.append(ratio)
+		pair = (id(g1[time1]), id(g2[time1]))
+		if pair not in ratio_by_pair:
+			edges1 = return_edge_key(g1[time1])[0]
+			edges2 = return_edge_key(g2[time1])[0]
+
+			w11 = np.intersect1d(edges1, edges2).size
+			w10 = edges1.size - w11
+			w01 =  edges2.size - w11
+			if (w11+w10+w01)>0:ratio_by_pair[pair] = w11/ (1.*(w11+w10+w01))
+			else:ratio_by_pair[pair]=0
+		jlist.append(ratio_by_pair[pair])
 	return np.mean(jlist)
 ########################################################################
 def check_init_pars(logl, logp, p0, data):
@@ -494,7 +763,7 @@ def check_init_pars(logl, logp, p0, data):
 
     return ok
 ########################################################
-def compute_diagnosis_lag_truth(graph, contact_datelist, filename):
+def compute_diagnosis_lag_truth(graph, nodelist, contact_datelist, filename):
 
 	diag_date = {}
 	infection_date={}
@@ -509,8 +778,10 @@ def compute_diagnosis_lag_truth(graph, contact_datelist, filename):
 			if diagnosis==1: infection_date[node] = timestep
 		
 
-	for node, time1, time2 in sorted(contact_datelist):
-		daylist = [day for day in contact_datelist[(node, time1, time2)] if graph[day-1].degree(node)>0]
+	node_index = return_node_index(nodelist)
+	for num, (node_pos, time1, time2) in enumerate(contact_datelist['sick_cases'].tolist()):
+		node = nodelist[node_pos]
+		daylist = [day for day in contact_datelist['days'][0, num, :contact_datelist['ndays'][0, num]] if graph[day-1].indptr[node_index[node]+1] > graph[day-1].indptr[node_index[node]]]
 		pos = [pos for pos, date in enumerate(daylist) if date==infection_date[node]][0]
 		lag_truths.append(ss.randint.cdf(pos,  0,  len(daylist)))
 
@@ -5,7 +5,7 @@ import csv
 import numpy as np
 from numpy import ma
 from emcee import PTSampler
-from emcee import autocorr
+import autocorr
 import corner
 import copy
 import matplotlib.pyplot as plt
@@ -14,62 +14,64 @@ from multiprocess import Pool
 import INoDS_convenience_functions as nf
 import warnings
 import scipy.stats as ss
+import scipy.sparse as sparse
 import cPickle
 import time
-import itertools
+import os
 import pandas as pd
 np.seterr(invalid='ignore')
 np.seterr(divide='ignore')
 warnings.simplefilter("ignore")
 warnings.warn("deprecated", DeprecationWarning)
 ########################################################################
-def compare_asocial_social_rate(best_par, data, contact_daylist, diagnosis_lag, recovery_prob, nsick_param, max_recovery_time,time_min, time_max):
+def compare_asocial_social_rate(best_par, data, contact_daylist, diagnosis_lag, recovery_prob, nsick_param, max_recovery_time,time_min, time_max, infected_strength=None):
 	r""" Significance test for beta parameter. The function compared social force (=beta*weight*infective degree) with epsilon at each trasnsmission event.
-	Beta is considered to be significant if the percenrtage events where a < FOI is 5% or less
+	Beta is considered to be significant if the percenrtage events where a < FOI is 5% or less.
+	infected_strength = precomputed infected strength of the network hypothesis (nodes x timesteps)
 	"""
 	
 	G_raw, health_data, node_health, nodelist, truth, time_min, time_max, seed_date  = data
-	health_data_new = copy.deepcopy(health_data)
-	node_health_new = copy.deepcopy(node_health)
 	p = to_params(best_par, False, diagnosis_lag, nsick_param, recovery_prob, None)
 	network=0 
 	G= G_raw[0]
 
 	network_min_date = min(G.keys())
+	if infected_strength is None: infected_strength = calculate_infected_strength(G_raw[0], nf.create_infected_matrix(health_data), time_min, time_max)
 	
 	if diagnosis_lag:
-		infected_strength, healthy_nodelist, infection_date = diagnosis_adjustment(G, network, p,nodelist, contact_daylist, recovery_prob,max_recovery_time, node_health_new, health_data_new)
+		adjacency_stack = nf.stack_adjacency(G, len(nodelist), time_min, time_max)
+		infection_node, infection_day, changed_node, changed_day = diagnosis_adjustment(network, p,nodelist, contact_daylist, recovery_prob,max_recovery_time, time_min, time_max)
+		delta_position, delta_weight = return_strength_delta(adjacency_stack, changed_node, changed_day, infected_strength.shape, time_min)
 
 	else: 
-		healthy_nodelist = return_healthy_nodelist(node_health)	
-		infection_date = [(node, time1) for node in node_health if node_health[node].has_key(1) for (time1,time2) in node_health[node][1]]
-		infection_date = sorted(infection_date)
-		infected_strength = {0:{node:{time: calculate_infected_strength(node, time, health_data, G_raw[0]) for time in range(time_min, time_max+1)} for node in nodelist}}
+		infection_node, infection_day = health_data['sick_periods'][:, 0], health_data['sick_periods'][:, 1]
+		delta_position, delta_weight = None, None
 
+	learn_position = return_infection_index(infection_node, infection_day, seed_date, network_min_date, time_min, infected_strength.shape[1])
+	beta_learn = p["beta"][0]*return_learn_strength(infected_strength, learn_position, delta_position, delta_weight)
 	
-	beta_learn = [p["beta"][0]*infected_strength[network][focal_node][sick_day-1] for (focal_node, sick_day) in infection_date if sick_day!=seed_date  and sick_day > network_min_date]
-
-	epsilon_learn = [p["epsilon"][0] for (focal_node, sick_day) in infection_date if sick_day!=seed_date and sick_day > network_min_date]
-	
-	plist = [a > b for (b,a) in zip(beta_learn, epsilon_learn)]
-	if len(plist) >0: return sum(plist)/(1.*len(plist))
+	plist = p["epsilon"][0] > beta_learn
+	if len(plist) >0: return plist.sum()/(1.*len(plist))
 	else: return "N/A"
 
 
 #########################################################################
-def diagnosis_adjustment(G, network, p, nodelist,contact_daylist,  recovery_prob, max_recovery_time, node_health_new, health_data_new):
-
-
+def diagnosis_adjustment(network, p, nodelist,contact_daylist,  recovery_prob, max_recovery_time, time_min, time_max):
+	r""" Impute the true infection (and recovery) date of sick nodes. Returns the
+	imputed infection events (node position, day) and the node-days gained by the 
+	imputation, i.e., the days before the first sick report and after the last sick 
+	report on which the node is now infected. All sick cases are imputed together from the 
+	padded candidate days (contact_daylist) and recovery bounds (max_recovery_time)"""
+
+	node, time1, time2 = contact_daylist['sick_cases'][:, 0], contact_daylist['sick_cases'][:, 1], contact_daylist['sick_cases'][:, 2]
+	contact_days, contact_ndays = contact_daylist['days'][network], contact_daylist['ndays'][network]
 	###ensure that the proposal do not include 0 and are <1 
-	diag_list = [min(max(num,0.000001),1) for num in p['diag_lag'][0]]
+	diag_lag = np.clip(p['diag_lag'][0], 0.000001, 1)
 	
-	##compute lagged time for each infection time
-	lag_dict = [(node, time1, time2, int(ss.randint.ppf(diag_lag, 0,  len(contact_daylist[network][(node, time1, time2)])))) for (node, time1, time2), diag_lag in zip(sorted(contact_daylist[network]), diag_list)]
-		
-	## pick out corresponding date from contact_daylist
-	new_infection_time= [(node, time1, time2, contact_daylist[network][(node, time1, time2)][lag_pos]) for (node, time1, time2, lag_pos) in lag_dict]
-	##order = node, old infection time, old recovery time, new infection time and new recovery time
-	new_infect_recovery_time =  [(node, time1, time2, new_time1, time2) for (node, time1, time2, new_time1) in new_infection_time]
+	##compute lagged time for each infection time and pick out corresponding date from contact_daylist
+	lag_pos = return_integer(randint_ppf(diag_lag, 0, contact_ndays))
+	new_time1 = contact_days[np.arange(len(node)), lag_pos]
+	new_time2 = time2
 		
 	#########################################################
 	# imputing recovery date##
@@ -77,49 +79,110 @@ def diagnosis_adjustment(G, network, p, nodelist,contact_daylist,  recovery_prob
 	if recovery_prob:
 	
 		###ensure that the proposal recovery times do not include 0 and are <1 
-		recovery_list = [min(max(num,0.000001),1) for num in p['gamma'][0]]
+		recovery = np.clip(p['gamma'][0], 0.000001, 1)
 			
 		## pick out corresponding recovery date (+1 to include period after time2  and time including max_recovery_time)
-		new_infect_recovery_time = [(node, time1, time2, new_time1, int(ss.randint.ppf(recovery_param, time2,  max_recovery_time[(node, time1, time2)]+1))) for (node, time1, time2, new_time1, new_time2), recovery_param in zip(sorted(new_infect_recovery_time), recovery_list)]	
+		new_time2 = return_integer(randint_ppf(recovery, time2, max_recovery_time+1))
 	##########################################################
 
-	for (node, time1, time2, new_time1, new_time2) in new_infect_recovery_time:
-		node_health_new[node][1].remove((time1, time2))
-		node_health_new[node][1].append((new_time1, new_time2))	
-		
-		health_data_new[node] = {day: 1 for day in range(new_time1, new_time2+1)}
-			
-	infected_strength={}
-	infected_strength[network] = {node:{time: calculate_infected_strength(node, time, health_data_new, G) for time in G.keys()} for node in nodelist}
+	##days the node is infected in addition to the reported sick period 
+	##(before the first sick report and after the last sick report)
+	before_start, after_start = np.maximum(new_time1, time_min), np.maximum(time2+1, time_min)
+	nbefore = np.maximum(np.minimum(time1, time_max+1) - before_start, 0)
+	nafter = np.maximum(np.minimum(new_time2, time_max)+1 - after_start, 0)
+	offset = nf.return_run_offsets(nbefore + nafter)
+	nbefore_day = np.repeat(nbefore, nbefore + nafter)
+	changed_day = np.where(offset < nbefore_day, np.repeat(before_start, nbefore + nafter) + offset, np.repeat(after_start, nbefore + nafter) + offset - nbefore_day)
 
-	healthy_nodelist = return_healthy_nodelist(node_health_new)
+	#infection events
+	return node.astype(np.int), new_time1.astype(np.int), np.repeat(node, nbefore + nafter).astype(np.int), changed_day.astype(np.int)
 
-	#create infection date list
-	infection_date = [(node, new_time1) for (node, time1, time2, new_time1, new_time2) in new_infect_recovery_time]
-	infection_date = sorted(infection_date)	
+#########################################################################
+def randint_ppf(q, low, high):
+	r""" Inverse CDF of the discrete uniform distribution on low, ..., high-1, evaluated 
+	elementwise with the same arithmetic as ss.randint.ppf (q = 0 gives low-1, q = 1 gives 
+	high-1, nan if q is outside [0, 1] or high <= low)"""
+
+	q, low, high = np.broadcast_arrays(np.asarray(q, dtype=np.float), low, high)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		vals = np.ceil(q*(high - low) + low) - 1
+		vals1 = np.clip(vals - 1, low, high)
+		ppf = np.where((np.floor(vals1) - low + 1.)/(high - low) >= q, vals1, vals)
+		ppf = np.where(q==1, high-1, ppf)
+		ppf = np.where((q>0) & (q<=1) & (high>low), ppf, np.nan)
 	
-	return infected_strength, healthy_nodelist, infection_date
+	return np.where(q==0, low-1, ppf)
+
+#########################################################################
+def return_integer(values):
+	r""" Integer array of values. Raises ValueError on nan, as int() does"""
+
+	values = np.asarray(values)
+	if np.isnan(values).any(): raise ValueError("cannot convert float NaN to integer")
+	return values.astype(np.int)
+
+#########################################################################
+def return_strength_delta(adjacency_stack_network, changed_node, changed_day, strength_shape, time_min):
+	r""" Change in infected strength when changed_node[i] is newly infected at 
+	changed_day[i] (the neighbours gain the edge weight to the node). Returns the
+	sorted flat positions in the (nodes x timesteps) strength array and the summed 
+	change in strength at each position. Only the changed node-days are touched, so 
+	the strength array under the reported health data is never copied"""
+
+	if len(changed_node)==0: return np.zeros(0, dtype=np.int), np.zeros(0)
+
+	n_nodes, n_times = strength_shape
+	changed_day = changed_day - time_min
+	##rows of the stacked adjacency matrix = edges of the changed nodes on the changed days
+	##(a static network is stored as a single nodes x nodes matrix)
+	if adjacency_stack_network.shape[0]==n_nodes: delta = adjacency_stack_network[changed_node].tocoo()
+	else: delta = adjacency_stack_network[changed_day*n_nodes + changed_node].tocoo()
+	delta_position, inverse = np.unique(delta.col*n_times + changed_day[delta.row], return_inverse=True)
+
+	return delta_position, np.bincount(inverse, weights=delta.data, minlength=len(delta_position))
+
+#########################################################################
+def return_matches(sorted_position, position):
+	r""" For each entry of position, returns True if it is present in 
+	sorted_position, and its location in sorted_position"""
+
+	location = np.minimum(np.searchsorted(sorted_position, position), max(len(sorted_position)-1, 0))
+	if len(sorted_position)==0: return np.zeros(len(position), dtype=bool), location
+	return sorted_position[location]==position, location
+
+#########################################################################
+def return_learn_strength(infected_strength_network, learn_position, delta_position, delta_weight):
+	r""" Infected strength at the learn positions, including the change in 
+	strength (if any) caused by the imputed infection and recovery dates"""
+
+	learn_strength = np.take(infected_strength_network, learn_position)
+	if delta_position is not None:
+		found, location = return_matches(delta_position, learn_position)
+		learn_strength[found] += delta_weight[location[found]]
+
+	return learn_strength
 
 #######################################################################
-def log_likelihood(parameters, data, infection_date, infected_strength, healthy_nodelist, null_comparison, diagnosis_lag,  recovery_prob, nsick_param, contact_daylist, max_recovery_time, parameter_estimate):
-	r"""Computes the log-likelihood of network given infection data """
+def log_likelihood(parameters, data, likelihood_index, infected_strength, strength_histogram, adjacency_stack, null_comparison, diagnosis_lag,  recovery_prob, nsick_param, contact_daylist, max_recovery_time, parameter_estimate):
+	r"""Computes the log-likelihood of network given infection data.
+	likelihood_index[network] holds the flat position arrays returned
+	by return_likelihood_index. If strength_histogram is supplied (no diagnosis 
+	lag) the likelihood is computed from the compressed strength histogram.
+	With diagnosis lag, infected_strength is the strength under the reported 
+	health data, strength_histogram holds its histogram over the healthy node-days
+	and adjacency_stack[network] the stacked adjacency matrix"""
 	
 	if null_comparison:
 		G_raw, health_data, node_health, nodelist, truth, time_min, time_max, seed_date,parameter_estimate = data
-		health_data_new = copy.deepcopy(health_data)
-		node_health_new = copy.deepcopy(node_health)		
 		p = to_params(parameters, null_comparison, diagnosis_lag, nsick_param, recovery_prob, parameter_estimate)
 		network = int(p['model'][0])
 		G = G_raw[network]
 	else:
 		G_raw, health_data, node_health, nodelist, truth, time_min, time_max, seed_date  = data
-		health_data_new = copy.deepcopy(health_data)
-		node_health_new = copy.deepcopy(node_health)
 		p = to_params(parameters, null_comparison, diagnosis_lag, nsick_param, recovery_prob, parameter_estimate)
 		network=0 
 		G= G_raw[0]
 
-	network_min_date = min(G.keys())
 	###############################################################################################
 	##diagnosis lag==
 	##impute true infection date and recovery date (if SIR/SIS...)
@@ -130,75 +193,192 @@ def log_likelihood(parameters, data, infection_date, infected_strength, healthy_
 	##################################################################################################
 	
 	if diagnosis_lag:
-		infected_strength, healthy_nodelist, infection_date = diagnosis_adjustment(G, network, p, nodelist, contact_daylist, recovery_prob, max_recovery_time, node_health_new, health_data_new)
-		
-	######################################################################	
+		infection_node, infection_day, changed_node, changed_day = diagnosis_adjustment(network, p, nodelist, contact_daylist, recovery_prob, max_recovery_time, time_min, time_max)
+		delta_position, delta_weight = return_strength_delta(adjacency_stack[network], changed_node, changed_day, infected_strength[network].shape, time_min)
+		##healthy periods are not altered by imputation, only the infection dates are re-indexed
+		learn_position = return_infection_index(infection_node, infection_day, seed_date, min(G.keys()), time_min, infected_strength[network].shape[1])
+		loglike = log_likelihood_lag(p['beta'][0], p['epsilon'][0], infected_strength[network], learn_position, likelihood_index[network][1], strength_histogram[network], delta_position, delta_weight)
 
+	elif strength_histogram is not None:
+		loglike = log_likelihood_histogram(p['beta'][0], p['epsilon'][0], strength_histogram[network])
+
+	else: 
+		###########################################################
+		## Calculate overall log likelihood                       #
+		########################################################### 
+		loglike = log_likelihood_kernel(p['beta'][0], p['epsilon'][0], infected_strength[network], likelihood_index[network])
+
+	if loglike == -np.inf or np.isnan(loglike) or loglike==0:return -np.inf
+	else: return loglike
+
+#############################################################################
+def log_likelihood_kernel(beta, epsilon, infected_strength_network, likelihood_index_network):
+	r""" Sum of log(lambda) over all infection events and of log(1-lambda) over
+	all days the nodes were (either reported or inferred) healthy. 
+	infected_strength_network is the (nodes x timesteps) infected strength array"""
+
+	learn_position, healthy_position = likelihood_index_network
 	################################################################
 	##Calculate rate of learning for all sick nodes at all sick    #
 	## dates, but not when sick day is the seed date (i.e., the    #
 	## first  report of the infection in the network               #
 	################################################################
-	overall_learn = itertools.chain(np.log(calculate_lambda1(p['beta'][0], p['epsilon'][0], infected_strength[network], focal_node, sick_day)) for (focal_node, sick_day) in infection_date if sick_day!=seed_date and sick_day > network_min_date)
+	overall_learn = np.log(calculate_lambda1(beta, epsilon, np.take(infected_strength_network, learn_position)))
 	################################################################
 	##Calculate rate of NOT learning for all the days the node was #
 	## (either reported or inferred) healthy                       #
 	################################################################
-	overall_not_learn = itertools.chain(not_learned_rate(focal_node,healthy_day1, healthy_day2, p['beta'][0],p['epsilon'][0], infected_strength[network], seed_date, network_min_date) for (focal_node,healthy_day1, healthy_day2) in healthy_nodelist)	
-	
-	###########################################################
-	## Calculate overall log likelihood                       #
-	########################################################### 
-	loglike = sum(overall_learn) + sum(overall_not_learn)
-	#print p['beta'][0], network_min_date, [(sick_day, round(infected_strength[network][focal_node][sick_day-1],2)) for (focal_node, sick_day) in infection_date if sick_day!=seed_date  and sick_day > network_min_date and  round(infected_strength[network][focal_node][sick_day-1],2)>0]
-	if loglike == -np.inf or np.isnan(loglike) or (sum(overall_learn) + sum(overall_not_learn)==0):return -np.inf
-	else: return loglike
+	overall_not_learn = np.log1p(-calculate_lambda1(beta, epsilon, np.take(infected_strength_network, healthy_position)))
+
+	return overall_learn.sum() + overall_not_learn.sum()
 
 #############################################################################
-def not_learned_rate(focal_node, healthy_day1, healthy_day2, beta, epsilon, infected_strength_network, seed_date, network_min_date):
-	r""" Calculate 1- lambda for all uninfected days and returns 
-	sum of log(1-lambdas)"""
+def log_likelihood_histogram(beta, epsilon, strength_histogram_network):
+	r""" Same as log_likelihood_kernel, but computed from the histogram of 
+	(unique infected strength, count) pairs. Cost scales with the number of 
+	distinct strength values instead of the number of node-days"""
 
-	lambda_list = itertools.chain(1-calculate_lambda1(beta, epsilon, infected_strength_network, focal_node, date) for date in [date1 for date1 in range(healthy_day1, healthy_day2+1) if date1!=seed_date and date1>network_min_date])
-	return sum(itertools.chain(np.log(num) for num in list(lambda_list)))
+	learn_strength, learn_count, healthy_strength, healthy_count = strength_histogram_network
+	overall_learn = np.dot(learn_count, np.log(calculate_lambda1(beta, epsilon, learn_strength)))
+	overall_not_learn = np.dot(healthy_count, np.log1p(-calculate_lambda1(beta, epsilon, healthy_strength)))
 
-##############################################################################
-def return_healthy_nodelist(node_health1):
-	r""" healthy_nodelist is a list. Format = [(node1, day1, day2),...]
-	where node1 is a node reported health and day1-day2 are the days
-	when the node is uninfected"""
+	return overall_learn + overall_not_learn
+
+#############################################################################
+def log_likelihood_lag(beta, epsilon, infected_strength_network, learn_position, healthy_position, strength_histogram_network, delta_position, delta_weight):
+	r""" log_likelihood_kernel under imputed infection and recovery dates. The healthy
+	node-days are summed from the histogram of the reported health data and corrected
+	only at the positions where the imputation changed the infected strength"""
+
+	learn_strength = return_learn_strength(infected_strength_network, learn_position, delta_position, delta_weight)
+	overall_learn = np.log(calculate_lambda1(beta, epsilon, learn_strength)).sum()
+
+	healthy_strength, healthy_count = strength_histogram_network[2:]
+	overall_not_learn = np.dot(healthy_count, np.log1p(-calculate_lambda1(beta, epsilon, healthy_strength)))
+	##healthy node-days with a changed infected strength
+	found = return_matches(healthy_position, delta_position)[0]
+	old_strength = np.take(infected_strength_network, delta_position[found])
+	new_strength = old_strength + delta_weight[found]
+	overall_not_learn += (np.log1p(-calculate_lambda1(beta, epsilon, new_strength)) - np.log1p(-calculate_lambda1(beta, epsilon, old_strength))).sum()
+
+	return overall_learn + overall_not_learn
+
+#############################################################################
+def return_strength_histogram(infected_strength, likelihood_index):
+	r""" Sufficient statistics of the likelihood when there is no diagnosis lag.
+	lambda depends only on beta, epsilon and the infected strength of the day, so 
+	the infection events and healthy node-days are reduced to (unique strength, count)
+	pairs. Format = strength_histogram[network] = (learn_strength, learn_count, 
+	healthy_strength, healthy_count). With diagnosis lag (no learn positions) only 
+	the healthy node-days are reduced"""
+
+	strength_histogram = {}
+	for network in likelihood_index:
+		learn_position, healthy_position = likelihood_index[network]
+		if learn_position is None: learn_strength, learn_count = None, None
+		else: learn_strength, learn_count = np.unique(np.take(infected_strength[network], learn_position), return_counts=True)
+		healthy_strength, healthy_count = np.unique(np.take(infected_strength[network], healthy_position), return_counts=True)
+		strength_histogram[network] = (learn_strength, learn_count, healthy_strength, healthy_count)
+
+	return strength_histogram
+
+#############################################################################
+def return_infection_index(infection_node, infection_day, seed_date, network_min_date, time_min, n_times):
+	r""" Flat position (node, previous day) in the (nodes x timesteps) infected 
+	strength array for all infection events, except those on the seed date or 
+	on/before the first day of the network"""
+
+	keep = (infection_day!=seed_date) & (infection_day > network_min_date)
 	
-	healthy_nodelist = itertools.chain((node, healthy_day1, healthy_day2) for node in node_health1 if node_health1[node].has_key(0) for healthy_day1, healthy_day2 in node_health1[node][0])
-	healthy_nodelist = sorted(list(healthy_nodelist))
+	return infection_node[keep]*n_times + infection_day[keep]-1-time_min
+
+#############################################################################
+def return_healthy_index(healthy_periods, seed_date, network_min_date, time_min, n_times):
+	r""" Sorted flat position (node, previous day) in the (nodes x timesteps) infected
+	strength array for all node-days in healthy_periods, except the seed date and 
+	days on/before the first day of the network"""
+
+	healthy_node, start_day, end_day = healthy_periods[:, 0], healthy_periods[:, 1], healthy_periods[:, 2]
 	
-	return healthy_nodelist	
+	##expand each (day1, day2) period into its days
+	ndays = np.maximum(end_day - start_day + 1, 0)
+	healthy_node = np.repeat(healthy_node, ndays)
+	period_start = np.cumsum(ndays) - ndays
+	days = np.arange(ndays.sum()) - np.repeat(period_start - start_day, ndays)
+
+	keep = (days!=seed_date) & (days > network_min_date)
+	return np.sort(healthy_node[keep]*n_times + days[keep]-1-time_min)
+
+#############################################################################
+def return_likelihood_index(G_raw, health_data, seed_date, time_min, diagnosis_lag):
+	r""" Flat position arrays used by log_likelihood_kernel. Format =
+	likelihood_index[network] = (learn_position, healthy_position). With diagnosis
+	lag the infection events are imputed and learn_position is None. 
+	Networks with the same first day share the same arrays"""
+
+	sick_periods = health_data['sick_periods']
+	n_times = health_data['status'].shape[1]
+	index_by_date = {}
+	likelihood_index = {}
+	for network in G_raw:
+		network_min_date = min(G_raw[network].keys())
+		if network_min_date not in index_by_date:
+			if diagnosis_lag: learn_position = None
+			else: learn_position = return_infection_index(sick_periods[:, 0], sick_periods[:, 1], seed_date, network_min_date, time_min, n_times)
+			index_by_date[network_min_date] = (learn_position, return_healthy_index(health_data['healthy_periods'], seed_date, network_min_date, time_min, n_times))
+		likelihood_index[network] = index_by_date[network_min_date]
+
+	return likelihood_index
 	
 ###############################################################################
-def calculate_lambda1(beta1, epsilon1, infected_strength_network, focal_node, date):
+def calculate_lambda1(beta1, epsilon1, infected_strength):
 	r""" This function calculates the infection potential of the 
 	focal_node based on (a) its infected_strength at the previous time step (date-1),
-	and (b) tranmission potential unexplained by the individual's network connections."""
+	and (b) tranmission potential unexplained by the individual's network connections.
+	infected_strength can be a scalar or an array of strengths"""
 	
-	prob_not_infected = np.exp(-(beta1*infected_strength_network[focal_node][date-1] + epsilon1))
+	prob_not_infected = np.exp(-(beta1*infected_strength + epsilon1))
 	#avoid returning 1 which will lead lnlike to be -np.inf
-	return min(1-prob_not_infected, 0.99999999)
+	return np.minimum(1-prob_not_infected, 0.99999999)
 
 ################################################################################
-def calculate_infected_strength(node, time1, health_data_new, G):
-	r""" This function calculates the infected strength of focal node = node 
-	as the sum of the weighted edge connections of the node at time=time1. Only
-	those nodes are considered that are reported as sick (= 1) at time1."""
+def calculate_infected_strength(G, infected, time_min, time_max):
+	r""" This function calculates the infected strength of all nodes at all 
+	time-points between time_min and time_max. Infected strength of a focal node 
+	is the sum of the weighted edge connections to nodes reported as sick (= 1
+	in the (nodes x timesteps) infected indicator matrix).
+	Returns an array of shape (nodes x timesteps), rows ordered as in nodelist"""
 	
-	## infected strength is sum of all edge weights of focal nodes connecting to infected nodes
-	## NOTE: health_data_new[node_i].get(time1) checks if time1 is present in health_data[node_i] AND if the value is 1
-		
+	## each time slice is one product of the sparse adjacency matrix with the 
+	## infected indicator vector. The product is reused on consecutive days with 
+	## the same matrix (static network) and the same infected nodes
+	infected_strength = np.zeros(infected.shape)
+	time_list = sorted([time1 for time1 in G if time_min<= time1 <=time_max])
+	for num, time1 in enumerate(time_list):
+		col = time1-time_min
+		if num>0 and time_list[num-1]==time1-1 and G[time1] is G[time1-1] and np.array_equal(infected[:, col], infected[:, col-1]):
+			infected_strength[:, col] = infected_strength[:, col-1]
+		else: infected_strength[:, col] = G[time1].dot(infected[:, col])
+	
+	return infected_strength
 
-	if time1 in G and node in G[time1].nodes(): 
-		strength = itertools.chain(G[time1][node][node_i]["weight"] for node_i in G[time1].neighbors(node) if (node_i in health_data_new and health_data_new[node_i].get(time1)))
-		
-		
-	else: strength=[]
-	return sum(strength)
+################################################################################
+def calculate_infected_strength_tensor(G_raw, health_data, nodelist, time_min, time_max):
+	r""" Infected strength for all networks in G_raw. Returns an array 
+	of shape (networks x nodes x timesteps), nodes ordered as in nodelist"""
+
+	infected = nf.create_infected_matrix(health_data)
+	infected_strength = np.zeros((len(G_raw), len(nodelist), time_max-time_min+1))
+	for network in G_raw: infected_strength[network] = calculate_infected_strength(G_raw[network], infected, time_min, time_max)
+
+	return infected_strength
+
+################################################################################
+def return_adjacency_stack(G_raw, nodelist, time_min, time_max):
+	r""" Stacked sparse adjacency matrix of all networks in G_raw (see
+	nf.stack_adjacency). Format = adjacency_stack[network]"""
+
+	return {network: nf.stack_adjacency(G_raw[network], len(nodelist), time_min, time_max) for network in G_raw}
 
 ################################################################################
 def to_params(arr, null_comparison, diagnosis_lag, nsick_param, recovery_prob, parameter_estimate):
@@ -247,7 +427,11 @@ def autocor_checks(sampler, output_filename):
 	r""" Perform autocorrelation checks"""
 
 	print('Chains contain samples after thinning (= 5) across all walkers ='), sampler.chain.shape[-2]*sampler.chain.shape[1]
-	f = [autocorr.function(sampler.chain[0, i, :])  for i in range(3)]
+	ess = estimate_effective_sample_size(sampler.chain[0])
+	if ess is None: print ("Chains are too short to estimate the effective sample size")
+	else: print ("Effective sample size of each parameter ="), np.round(ess, 1)
+	##one FFT for the three walkers
+	f = autocorr.function(sampler.chain[0, :3], axis=1)
 
         ax = plt.figure().add_subplot(111)
 	for i in range(3):
@@ -270,6 +454,61 @@ def log_evidence(sampler):
 	logZerr = abs(logZ2 - logZ)
 	return logZ, logZerr
 
+#####################################################################
+def init_evidence_state(ntemps, nwalkers):
+	r"""Running sums for the evidence estimators (see update_evidence_state). Per temperature and 
+	walker: number, sum and sum of squares of the finite log-likelihoods. Per pair of adjacent 
+	temperatures: number of samples and the scaled sums of the stepping-stone weights"""
+
+	return {'count':np.zeros((ntemps, nwalkers)), 'sum':np.zeros((ntemps, nwalkers)), 'sum2':np.zeros((ntemps, nwalkers)),
+		'ss_count':0, 'ss_max':np.zeros(ntemps-1) - np.inf, 'ss_sum':np.zeros(ntemps-1), 'ss_sum2':np.zeros(ntemps-1)}
+
+#####################################################################
+def update_evidence_state(evidence_state, betas, lnlike):
+	r"""Adds the log-likelihoods of one step (lnlike, temperatures x walkers) to the running sums. 
+	The stepping-stone weights exp((betas[num]-betas[num+1])*lnlike[num+1]) are summed relative to 
+	their running maximum ss_max, so they never overflow"""
+
+	finite = np.isfinite(lnlike)
+	evidence_state['count'] += finite
+	evidence_state['sum'] += np.where(finite, lnlike, 0)
+	evidence_state['sum2'] += np.where(finite, lnlike, 0)**2
+
+	log_weight = -np.diff(betas)[:, None]*lnlike[1:]
+	new_max = np.maximum(evidence_state['ss_max'], log_weight.max(axis=1))
+	##no finite weight yet
+	new_max[np.isinf(new_max)] = 0
+	scale = np.exp(evidence_state['ss_max'] - new_max)
+	evidence_state['ss_sum'] = evidence_state['ss_sum']*scale + np.exp(log_weight - new_max[:, None]).sum(axis=1)
+	evidence_state['ss_sum2'] = evidence_state['ss_sum2']*scale**2 + np.exp(2*(log_weight - new_max[:, None])).sum(axis=1)
+	evidence_state['ss_max'] = new_max
+	evidence_state['ss_count'] += lnlike.shape[1]
+
+#####################################################################
+def return_evidence(evidence_state, betas):
+	r"""Log evidence (from the coldest to the hottest temperature) and its error by thermodynamic 
+	integration and by stepping stone. The thermodynamic integration error combines the 
+	discretization error (as in log_evidence) and the Monte Carlo error of the mean log-likelihoods, 
+	the stepping-stone error is the Monte Carlo error of the log ratios (delta method)"""
+
+	count, total = evidence_state['count'], evidence_state['sum']
+	##mean over the walkers of each walker's mean, as in log_evidence
+	moved = count>0
+	mean_logls = np.array([np.mean(total[num][moved[num]]/count[num][moved[num]]) for num in xrange(len(betas))])
+	logZ = -np.trapz(mean_logls, betas)
+	logZ2 = -np.trapz(mean_logls[::2], betas[::2])
+	variance = evidence_state['sum2'].sum(axis=1)/count.sum(axis=1) - (total.sum(axis=1)/count.sum(axis=1))**2
+	weight = np.zeros(len(betas))
+	weight[:-1] += -np.diff(betas)/2
+	weight[1:] += -np.diff(betas)/2
+	logZerr = np.sqrt((logZ - logZ2)**2 + np.sum(weight**2*variance/count.sum(axis=1)))
+
+	ss_count = float(evidence_state['ss_count'])
+	mean_weight = evidence_state['ss_sum']/ss_count
+	log_ratio = evidence_state['ss_max'] + np.log(mean_weight)
+	ratio_variance = (evidence_state['ss_sum2']/ss_count - mean_weight**2)/(ss_count*mean_weight**2)
+	return (logZ, logZerr), (log_ratio.sum(), np.sqrt(ratio_variance.sum()))
+
 #####################################################################
 def flatten_chain(sampler):
     r"""Flatten zero temperature chain"""
@@ -302,6 +541,80 @@ def summary(sampler):
     return CI
 
 ##############################################################################
+def log_prior_ensemble(positions, diagnosis_lag):
+	r"""log_prior of every walker in positions (walkers x parameters), without null comparison"""
+
+	inside = (positions[:, 0]>=0) & (positions[:, 0]<=1000) & (positions[:, 1]>=0) & (positions[:, 1]<=1000)
+	if diagnosis_lag:
+		##diag_lag (and gamma) parameters
+		inside &= ((positions[:, 2:]>=0.000001) & (positions[:, 2:]<=1)).all(axis=1)
+	return np.where(inside, 0., -np.inf)
+
+#####################################################################
+def log_likelihood_ensemble(beta, epsilon, strength_histogram_network, chunk_size=2**22):
+	r"""log_likelihood_histogram for arrays of beta and epsilon (one entry per walker), computed on
+	(walkers x strengths) arrays of at most chunk_size entries. A count of None counts each strength 
+	once (the infected strength at each learn and healthy position, as in log_likelihood_kernel)"""
+
+	learn_strength, learn_count, healthy_strength, healthy_count = strength_histogram_network
+	loglike = np.zeros(len(beta))
+	step = max(1, chunk_size//max(len(learn_strength) + len(healthy_strength), 1))
+	for num in xrange(0, len(beta), step):
+		beta1, epsilon1 = beta[num:num+step, None], epsilon[num:num+step, None]
+		overall_learn = np.log(calculate_lambda1(beta1, epsilon1, learn_strength))
+		overall_not_learn = np.log1p(-calculate_lambda1(beta1, epsilon1, healthy_strength))
+		if learn_count is None: loglike[num:num+step] = overall_learn.sum(axis=1) + overall_not_learn.sum(axis=1)
+		else: loglike[num:num+step] = overall_learn.dot(learn_count) + overall_not_learn.dot(healthy_count)
+
+	loglike[np.isnan(loglike) | (loglike==0)] = -np.inf
+	return loglike
+
+#####################################################################
+class EnsembleEvaluator(object):
+	r"""Pool-like object for PTSampler when the likelihood only depends on beta and epsilon. 
+	PTSampler hands the positions of all the walkers updated in a (half) step to map, which 
+	evaluates their prior and likelihood with array operations instead of calling log_prior 
+	and log_likelihood for each walker"""
+
+	def __init__(self, strength_histogram_network, diagnosis_lag):
+		self.strength_histogram_network = strength_histogram_network
+		self.diagnosis_lag = diagnosis_lag
+
+	def map(self, function, positions):
+		r"""[(log-likelihood, log-prior)] of each walker in positions, function is ignored"""
+		positions = np.atleast_2d(positions)
+		logp = log_prior_ensemble(positions, self.diagnosis_lag)
+		##as in PTSampler, the likelihood is not computed outside the prior
+		logl = np.copy(logp)
+		inside = np.isfinite(logp)
+		logl[inside] = log_likelihood_ensemble(positions[inside, 0], positions[inside, 1], self.strength_histogram_network)
+		return zip(logl, logp)
+
+#####################################################################
+class TimedPool(object):
+	r"""Pool-like wrapper for PTSampler that records the latency of each walker evaluation
+	(see nf.record_likelihood_calls). Walkers evaluated together (by pool, e.g. a worker 
+	pool or EnsembleEvaluator) are each given the time of the map divided by their number.
+	pool = None evaluates the walkers one at a time, as PTSampler does without a pool"""
+
+	def __init__(self, pool=None):
+		self.pool = pool
+
+	def map(self, function, positions):
+		if self.pool is not None:
+			start = time.time()
+			results = self.pool.map(function, positions)
+			nf.record_likelihood_calls("walker", np.repeat((time.time()-start)/max(len(results), 1), len(results)))
+			return results
+		results, latency = [], []
+		for position in positions:
+			start = time.time()
+			results.append(function(position))
+			latency.append(time.time()-start)
+		nf.record_likelihood_calls("walker", latency)
+		return results
+
+#####################################################################
 def log_prior(parameters,  null_comparison, diagnosis_lag, nsick_param, recovery_prob, parameter_estimate):
     
     p = to_params(parameters, null_comparison, diagnosis_lag, nsick_param, recovery_prob, parameter_estimate)
@@ -324,8 +637,19 @@ def log_prior(parameters,  null_comparison, diagnosis_lag, nsick_param, recovery
 	
 
 #######################################################################
-def start_sampler(data, recovery_prob,  burnin, niter, verbose,  contact_daylist, max_recovery_time, nsick_param, diagnosis_lag=False, null_comparison=False,  **kwargs3):
-	r"""Sampling performed using emcee """
+def start_sampler(data, recovery_prob,  burnin, niter, verbose,  contact_daylist, max_recovery_time, nsick_param, diagnosis_lag=False, null_comparison=False, compressed_likelihood=True, threads=1, checkpoint_filename=None, checkpoint_interval=None, resume=False, target_ess=None, check_interval=50, adaptive_ladder=False, adapt_interval=10, infected_strength=None, **kwargs3):
+	r"""Sampling performed using emcee. If compressed_likelihood is True (and there
+	is no diagnosis lag), the likelihood is computed from the infected strength histogram.
+	With diagnosis lag, the walkers are evaluated by a pool of threads worker processes
+	that receive the log-likelihood arguments once (see start_worker_pool).
+	The sampler state is appended to checkpoint_filename every checkpoint_interval iterations. 
+	If resume is True, the run continues from the last checkpoint in checkpoint_filename.
+	If target_ess is given, burnin and niter are upper limits: every check_interval iterations 
+	the autocorrelation time is estimated, burn-in stops once it is longer than burnin_tau 
+	autocorrelation times and sampling stops once each parameter has target_ess independent samples.
+	If adaptive_ladder is True, the temperatures are tuned every adapt_interval burn-in iterations 
+	towards uniform swap acceptance, and redundant temperatures are dropped at the end of burn-in.
+	infected_strength = precomputed infected strength (networks x nodes x timesteps), e.g. from the cache"""
 
 	parameter_estimate=None
 	##############################################################################
@@ -363,84 +687,455 @@ def start_sampler(data, recovery_prob,  burnin, niter, verbose,  contact_daylist
 	##calculating infection date and infection strength outside loglik to speed up #
 	##computations
 	################################################################################
+	stage_start = time.time()
+	##with diagnosis lag, strength under the reported health data, updated for imputed dates in log_likelihood
+	if infected_strength is None: infected_strength = calculate_infected_strength_tensor(G_raw, health_data, nodelist, time_min, time_max)
 	if not diagnosis_lag:		
-		infection_date = [(node, time1) for node in node_health if node_health[node].has_key(1) for (time1,time2) in node_health[node][1]]
-		infection_date = sorted(infection_date)
-		infected_strength = {network:{node:{time: calculate_infected_strength(node, time, health_data, G_raw[network]) for time in range(time_min, time_max+1)} for node in nodelist} for network in G_raw}
-		pool = None
+		adjacency_stack = None
+		##the compressed likelihood is cheaper than sending the walkers to other processes
 		threads = 1
 		
 		
 	else: 
-		infection_date = None
-		infected_strength=None	
-		threads = 8
+		adjacency_stack = return_adjacency_stack(G_raw, nodelist, time_min, time_max)
 		
 
-	healthy_nodelist = return_healthy_nodelist(node_health)	
+	likelihood_index = return_likelihood_index(G_raw, health_data, seed_date, time_min, diagnosis_lag)
+	strength_histogram = None
+	if diagnosis_lag:
+		##healthy node-days under the reported health data, corrected in log_likelihood_lag
+		strength_histogram = return_strength_histogram(infected_strength, likelihood_index)
+	elif compressed_likelihood:
+		strength_histogram = return_strength_histogram(infected_strength, likelihood_index)
+		##the histogram replaces the strength array and the index arrays
+		infected_strength, likelihood_index = None, None
 	################################################################################
+	loglargs = (data, likelihood_index, infected_strength, strength_histogram, adjacency_stack, null_comparison, diagnosis_lag,  recovery_prob, nsick_param, contact_daylist, max_recovery_time, parameter_estimate)
+	pool = None
 	if threads>1:
-		
-		sampler = PTSampler(ntemps=ntemps, nwalkers=nwalkers, dim=ndim, betas=betas, logl=log_likelihood, logp=log_prior, a = 1.5,  loglargs=(data, infection_date, infected_strength, healthy_nodelist, null_comparison, diagnosis_lag,  recovery_prob, nsick_param, contact_daylist, max_recovery_time, parameter_estimate), logpargs=(null_comparison, diagnosis_lag, nsick_param, recovery_prob, parameter_estimate), threads=threads) 
+		##the workers hold loglargs, emcee only sends them the walker positions
+		pool = start_worker_pool(log_likelihood_worker, loglargs, threads)
+		sampler = PTSampler(ntemps=ntemps, nwalkers=nwalkers, dim=ndim, betas=betas, logl=pool_worker, logp=log_prior, a = 1.5, logpargs=(null_comparison, diagnosis_lag, nsick_param, recovery_prob, parameter_estimate), pool=TimedPool(pool)) 
 
 	if threads<=1:
-		sampler = PTSampler(ntemps=ntemps, nwalkers=nwalkers, dim=ndim, betas=betas, logl=log_likelihood, logp=log_prior, a = 1.5,  loglargs=(data, infection_date, infected_strength, healthy_nodelist, null_comparison, diagnosis_lag,  recovery_prob, nsick_param, contact_daylist, max_recovery_time, parameter_estimate), logpargs=(null_comparison, diagnosis_lag, nsick_param, recovery_prob, parameter_estimate)) 
-
-	#Run user-specified burnin
-	print ("burn in......")
-	for i, (p, lnprob, lnlike) in enumerate(sampler.sample(starting_guess, iterations = burnin)): 
-		if verbose:print("burnin progress..."), (100 * float(i) / burnin)
-		else: pass
+		ensemble = None
+		if not diagnosis_lag and not null_comparison:
+			##the likelihood only depends on beta and epsilon, the walkers are evaluated together
+			if strength_histogram is not None: ensemble = EnsembleEvaluator(strength_histogram[0], diagnosis_lag)
+			else: 
+				learn_position, healthy_position = likelihood_index[0]
+				ensemble = EnsembleEvaluator((np.take(infected_strength[0], learn_position), None, np.take(infected_strength[0], healthy_position), None), diagnosis_lag)
+		sampler = PTSampler(ntemps=ntemps, nwalkers=nwalkers, dim=ndim, betas=betas, logl=log_likelihood, logp=log_prior, a = 1.5,  loglargs=loglargs, logpargs=(null_comparison, diagnosis_lag, nsick_param, recovery_prob, parameter_estimate), pool=TimedPool(ensemble)) 
+	nf.record_stage("likelihood_setup", stage_start)
 
-	sampler.reset()
-	#################################
-	print ("sampling........")
 	nthin = 5
-	for i, (p, lnprob, lnlike) in enumerate(sampler.sample(p, lnprob0 = lnprob,  lnlike0= lnlike, iterations= niter, thin= nthin)):  
-		if verbose:print("sampling progress"), (100 * float(i) / niter)
-		else: pass
+	stage, done, p, lnprob, lnlike = "burnin", 0, starting_guess, None, None
+	##running average of the swap acceptance between adjacent temperatures
+	swap_rate = None
+	checkpoint = None
+	if resume: checkpoint = read_checkpoint(checkpoint_filename)
+	if checkpoint is not None:
+		stage, done, p, lnprob, lnlike = restore_checkpoint(sampler, checkpoint, burnin, niter)
+		swap_rate = checkpoint['swap_rate']
+		if checkpoint_interval is None: checkpoint_interval = checkpoint['checkpoint_interval']
+		print ("resuming from checkpoint........"), stage, done
+	
+	checkpoint_file = None
+	if checkpoint_filename is not None and checkpoint_interval:
+		checkpoint_file = open(checkpoint_filename, "ab" if checkpoint is not None else "wb")
+		run_info = {'burnin':burnin, 'niter':niter, 'checkpoint_interval':checkpoint_interval}
+		##checkpoints during sampling fall on thinned samples
+		sample_interval = nthin*int(np.ceil(checkpoint_interval/float(nthin)))
+	##convergence checks fall on thinned samples
+	check_interval = nthin*int(np.ceil(check_interval/float(nthin)))
+	adapt_interval = nthin*int(np.ceil(adapt_interval/float(nthin)))
+	burnin_tau = 5
+	
+	if stage == "burnin":
+		stage_start = time.time()
+		#Run user-specified burnin
+		print ("burn in......")
+		start, burned_in = done, False
+		while done < burnin and not burned_in:
+			##with an adaptive ladder, burn-in runs in blocks of adapt_interval iterations
+			block = min(adapt_interval, burnin-done) if adaptive_ladder else burnin-done
+			nswap_accepted, nswap = sampler.nswap_accepted.copy(), sampler.nswap.copy()
+			##the burn-in chain is only stored to estimate the autocorrelation time
+			for i, (p, lnprob, lnlike) in enumerate(sampler.sample(p, lnprob0 = lnprob,  lnlike0= lnlike, iterations = block, thin = nthin, storechain=target_ess is not None), done+1): 
+				if verbose:print("burnin progress..."), (100 * float(i) / burnin)
+				if checkpoint_file is not None and i % checkpoint_interval == 0 and i<burnin and not adaptive_ladder: 
+					write_checkpoint(checkpoint_file, sampler, run_info, ("burnin", i, p, lnprob, lnlike), None)
+				if target_ess is not None and i % check_interval == 0:
+					nsaved = (i-start) // nthin
+					tau = estimate_autocorr_time(sampler.chain[0, :, :nsaved])
+					if verbose: print ("burn-in autocorrelation time (iterations) ="), None if tau is None else nthin*tau
+					if tau is not None and nsaved >= burnin_tau*tau.max():
+						print ("burn-in converged after"), i, ("iterations")
+						burned_in = True
+						break
+			
+			if adaptive_ladder:
+				block_rate = return_swap_acceptance(sampler.nswap_accepted - nswap_accepted, sampler.nswap - nswap)
+				swap_rate = block_rate if swap_rate is None else 0.8*swap_rate + 0.2*block_rate
+				betas = adapt_temperature_ladder(sampler.betas, block_rate, done, i-done)
+				p, lnprob, lnlike = set_temperature_ladder(sampler, betas, p, lnprob, lnlike)
+				##checkpoints fall between blocks, once the ladder is updated
+				if checkpoint_file is not None and i // checkpoint_interval > done // checkpoint_interval and i<burnin:
+					write_checkpoint(checkpoint_file, sampler, run_info, ("burnin", i, p, lnprob, lnlike, swap_rate), None)
+			done = i
+
+		if adaptive_ladder:
+			betas, keep = prune_temperature_ladder(sampler.betas, swap_rate)
+			p, lnprob, lnlike = set_temperature_ladder(sampler, betas, p, lnprob, lnlike, keep)
+			print ("temperature ladder (inverse temperatures) ="), np.round(sampler.betas, 4)
+			print ("swap acceptance between adjacent temperatures ="), np.round(swap_rate, 3)
+		sampler.reset()
+		sampler.evidence_state = init_evidence_state(sampler.ntemps, sampler.nwalkers)
+		stage, done = "sampling", 0
+		if checkpoint_file is not None: write_checkpoint(checkpoint_file, sampler, run_info, (stage, done, p, lnprob, lnlike), None)
+		nf.record_stage("burnin", stage_start)
+	#################################
+	if stage == "sampling":
+		stage_start = time.time()
+		print ("sampling........")
+		saved = done // nthin
+		for i, (p, lnprob, lnlike) in enumerate(sampler.sample(p, lnprob0 = lnprob,  lnlike0= lnlike, iterations= niter-done, thin= nthin), done+1):  
+			if verbose:print("sampling progress"), (100 * float(i) / niter)
+			##the evidence is accumulated over the stored (thinned) samples
+			if i % nthin == 0: update_evidence_state(sampler.evidence_state, sampler.betas, lnlike)
+			if verbose and i % check_interval == 0: print ("log evidence and error (thermodynamic integration, stepping stone) ="), return_evidence(sampler.evidence_state, sampler.betas)
+			if checkpoint_file is not None and (i % sample_interval == 0 or i == niter): 
+				write_checkpoint(checkpoint_file, sampler, run_info, ("sampling", i, p, lnprob, lnlike), slice(saved, i // nthin))
+				saved = i // nthin
+			if target_ess is not None and i % check_interval == 0 and i<niter:
+				ess = estimate_effective_sample_size(sampler.chain[0, :, :i // nthin])
+				if verbose: print ("effective sample size ="), ess
+				if ess is not None and ess.min() >= target_ess:
+					stage = "converged"
+					break
+		
+		if stage == "converged":
+			##drop the samples allocated for the remaining iterations
+			sampler._chain, sampler._lnprob, sampler._lnlikelihood = sampler.chain[:, :, :i // nthin], sampler.lnprobability[:, :, :i // nthin], sampler.lnlikelihood[:, :, :i // nthin]
+			print ("sampling converged after"), i, ("iterations")
+			if checkpoint_file is not None: write_checkpoint(checkpoint_file, sampler, run_info, (stage, i, p, lnprob, lnlike), slice(saved, i // nthin))
+		nf.record_stage("sampling", stage_start)
 
+	if checkpoint_file is not None: checkpoint_file.close()
+	if target_ess is not None: print ("effective sample size of each parameter ="), estimate_effective_sample_size(sampler.chain[0])
 
 	
+	sampler.pool = None
+	if pool is not None:
+		pool.close()
+		pool.join()
+	
 	##############################
 	#The resulting samples are stored as the sampler.chain property:
-	assert sampler.chain.shape == (ntemps, nwalkers, niter/nthin, ndim)
+	assert stage == "converged" or sampler.chain.shape == (sampler.ntemps, nwalkers, niter/nthin, ndim)
 
 	return sampler
 #######################################################################
-def perform_null_comparison(data, recovery_prob,  burnin, niter, verbose,  contact_daylist, max_recovery_time, nsick_param, diagnosis_lag=False, null_comparison=True, **kwargs3):
-	r"""Sampling performed using emcee """
+def estimate_autocorr_time(chain):
+	r"""Integrated autocorrelation time (in samples) of each parameter, averaged over the walkers of 
+	chain (nwalkers, nsamples, ndim). None if the chain is too short for a reliable estimate"""
+
+	try: return autocorr.walker_autocorr_time(chain)
+	except ValueError: return None
+
+#######################################################################
+def estimate_effective_sample_size(chain):
+	r"""Number of independent samples of each parameter in chain (nwalkers, nsamples, ndim). 
+	None if the chain is too short to estimate the autocorrelation time"""
+
+	tau = estimate_autocorr_time(chain)
+	if tau is None: return None
+	return chain.shape[0]*chain.shape[1]/tau
+#######################################################################
+def write_checkpoint(checkpoint_file, sampler, run_info, state, samples):
+	r"""Appends a checkpoint record to checkpoint_file. state = (stage, iteration, p, lnprob, lnlike(, swap_rate)).
+	Only the samples stored since the previous record (samples = slice of the chain) are written, 
+	read_checkpoint concatenates them"""
+
+	stage, iteration, p, lnprob, lnlike = state[:5]
+	record = dict(run_info)
+	record.update({'stage':stage, 'iteration':iteration, 'p':p, 'lnprob':lnprob, 'lnlike':lnlike, 'random_state':np.random.get_state(),
+		'betas':sampler.betas, 'swap_rate':state[5] if len(state)>5 else None, 'evidence_state':getattr(sampler, 'evidence_state', None),
+		'nswap':sampler.nswap, 'nswap_accepted':sampler.nswap_accepted, 'nprop':sampler.nprop, 'nprop_accepted':sampler.nprop_accepted,
+		'chain':None, 'lnprobability':None, 'lnlikelihood':None})
+	if samples is not None:
+		record['chain'] = sampler.chain[:, :, samples, :]
+		record['lnprobability'] = sampler.lnprobability[:, :, samples]
+		record['lnlikelihood'] = sampler.lnlikelihood[:, :, samples]
+	cPickle.dump(record, checkpoint_file, protocol=2)
+	checkpoint_file.flush()
+	os.fsync(checkpoint_file.fileno())
+
+#######################################################################
+def read_checkpoint(checkpoint_filename):
+	r"""Returns the last record in checkpoint_filename, with the samples of all records. 
+	A record cut short by a crash is dropped (and truncated from the file). Returns None 
+	if there is no checkpoint"""
+
+	if not os.path.exists(checkpoint_filename): 
+		print ("no checkpoint found, starting a new run")
+		return None
+	record_list = []
+	end = 0
+	with open(checkpoint_filename, "rb") as checkpoint_file:
+		while True:
+			try: record_list.append(cPickle.load(checkpoint_file))
+			##end of file, or a partially written record
+			except Exception: break
+			end = checkpoint_file.tell()
+	with open(checkpoint_filename, "r+b") as checkpoint_file: checkpoint_file.truncate(end)
+	if not record_list: return None
+
+	checkpoint = record_list[-1]
+	for key in ['chain', 'lnprobability', 'lnlikelihood']:
+		samples = [record[key] for record in record_list if record[key] is not None]
+		checkpoint[key] = np.concatenate(samples, axis=2) if samples else None
+	return checkpoint
+
+#######################################################################
+def restore_checkpoint(sampler, checkpoint, burnin, niter):
+	r"""Restores the sampler, its samples and the random state from checkpoint. 
+	Returns (stage, iteration, p, lnprob, lnlike)"""
+
+	if checkpoint['burnin'] != burnin or checkpoint['niter'] != niter:
+		raise ValueError("The checkpoint was written for burnin = %s, iteration = %s"%(checkpoint['burnin'], checkpoint['niter']))
+	if checkpoint['p'].shape[1:] != (sampler.nwalkers, sampler.dim):
+		raise ValueError("The checkpoint does not match the number of parameters to estimate")
+
+	##the temperature ladder may have been tuned
+	sampler._betas, sampler.ntemps = checkpoint['betas'], len(checkpoint['betas'])
+	sampler.evidence_state = checkpoint['evidence_state']
+	sampler.nswap, sampler.nswap_accepted = checkpoint['nswap'], checkpoint['nswap_accepted']
+	sampler.nprop, sampler.nprop_accepted = checkpoint['nprop'], checkpoint['nprop_accepted']
+	sampler._chain, sampler._lnprob, sampler._lnlikelihood = checkpoint['chain'], checkpoint['lnprobability'], checkpoint['lnlikelihood']
+	np.random.set_state(checkpoint['random_state'])
+	return checkpoint['stage'], checkpoint['iteration'], checkpoint['p'], checkpoint['lnprob'], checkpoint['lnlike']
+
+#######################################################################
+def return_swap_acceptance(nswap_accepted, nswap):
+	r"""Swap acceptance between adjacent temperatures (num, num+1) from the swap counters of 
+	PTSampler, where each temperature counts the swaps with both of its neighbours"""
+
+	pair_accepted = np.zeros(len(nswap_accepted)-1)
+	for num in xrange(len(pair_accepted)):
+		pair_accepted[num] = nswap_accepted[num]
+		if num>0: pair_accepted[num] -= pair_accepted[num-1]
+	##the hottest temperature only swaps with its colder neighbour
+	return pair_accepted/nswap[-1]
+
+#######################################################################
+def adapt_temperature_ladder(betas, swap_rate, iteration, niterations, adaptation_lag=1000, adaptation_time=100):
+	r"""Moves the inverse temperatures towards uniform swap acceptance (Vousden et al. 2016, MNRAS 455). 
+	The temperature gap between two rungs grows if their swap acceptance is higher than that of the 
+	next pair. Adaptation slows down with the iteration. The coldest and hottest rungs are fixed"""
+
+	kappa = niterations/float(adaptation_time) * adaptation_lag/float(iteration + adaptation_lag)
+	temperature_gap = np.diff(1./betas[:-1])*np.exp(kappa*(swap_rate[:-1] - swap_rate[1:]))
+	new_betas = np.copy(betas)
+	new_betas[1:-1] = 1./(np.cumsum(temperature_gap) + 1./betas[0])
+	##keep the ladder ordered
+	if np.all(np.diff(new_betas)<0): return new_betas
+	return betas
+
+#######################################################################
+def prune_temperature_ladder(betas, swap_rate, target_swap=0.5, min_temps=5):
+	r"""Drops redundant temperatures. The rejection rate of each pair of adjacent rungs is taken as 
+	the distance between them, and the fewest rungs (but at least min_temps) whose swap acceptance 
+	stays near target_swap are spread evenly along that distance (the evidence needs closer rungs 
+	than mixing alone). Returns the new betas and, for each new rung, the nearest rung of the 
+	current ladder"""
+
+	distance = np.concatenate(([0], np.cumsum(1-swap_rate)))
+	ntemps = max(min_temps, 1 + int(np.ceil(distance[-1]/(1-target_swap))))
+	if ntemps >= len(betas): return betas, np.arange(len(betas))
+	position = np.linspace(0, distance[-1], ntemps)
+	new_betas = np.exp(np.interp(position, distance, np.log(betas)))
+	keep = np.abs(distance[None, :] - position[:, None]).argmin(axis=1)
+	return new_betas, keep
+
+#######################################################################
+def set_temperature_ladder(sampler, betas, p, lnprob, lnlike, keep=None):
+	r"""Replaces the inverse temperatures of the sampler by betas. The walkers of rung keep[num] of the 
+	current ladder move to rung num of the new ladder. Returns p, lnprob and lnlike on the new ladder"""
+
+	if keep is None: keep = np.arange(len(betas))
+	lnlike = lnlike[keep]
+	shift = (betas - sampler.betas[keep])[:, None]*lnlike
+	lnprob = lnprob[keep] + np.where(np.isfinite(lnlike), shift, 0)
+	sampler._betas, sampler.ntemps = betas, len(betas)
+	return p[keep], lnprob, lnlike
+
+#######################################################################
+worker_function, worker_args = None, ()
+
+def init_worker(function, args):
+	r"""Pool initializer, stores function and its arguments in the worker process"""
+
+	global worker_function, worker_args
+	worker_function, worker_args = function, args
+
+#######################################################################
+def pool_worker(item):
+	r"""Evaluates worker_function(worker_args, item) in a worker process (see start_worker_pool)"""
+
+	return worker_function(worker_args, item)
+
+#######################################################################
+def start_worker_pool(function, args, threads):
+	r"""Persistent pool of threads worker processes. function and args are passed to each
+	worker once, when it starts; afterwards pool.map(pool_worker, items) only sends the items.
+	The workers are forked on Linux and macOS, so they inherit args from this process: 
+	nothing is pickled and the read-only arrays are shared (copy-on-write) instead of copied.
+	Elsewhere args are pickled once per worker"""
+
+	return Pool(processes=threads, initializer=init_worker, initargs=(function, args))
+
+#######################################################################
+def log_likelihood_worker(loglargs, parameters):
+	r"""log_likelihood with the arguments held by the worker process"""
+
+	return log_likelihood(parameters, *loglargs)
+#######################################################################
+def perform_null_comparison(data, recovery_prob,  burnin, niter, verbose,  contact_daylist, max_recovery_time, nsick_param, diagnosis_lag=False, null_comparison=True, threads=1, batch_size=50, **kwargs3):
+	r"""Compute log-likelihood of the network hypothesis and all null networks. The
+	networks are scored in batches of batch_size networks (see null_likelihood_batch),
+	spread over threads processes. Returns the log-likelihoods in the order of G_raw"""
 
 	G_raw, health_data, node_health, nodelist, true_value,  time_min, time_max, seed_date,parameter_estimate = data
 
-	################################################################################
-	##calculating infection date and infection strength outside loglik to speed up #
-	##computations
-	################################################################################
-	if not diagnosis_lag:		
-		infection_date = [(node, time1) for node in node_health if node_health[node].has_key(1) for (time1,time2) in node_health[node][1]]
-		infection_date = sorted(infection_date)
-		infected_strength = {network:{node:{time: calculate_infected_strength(node, time, health_data, G_raw[network]) for time in range(time_min, time_max+1)} for node in nodelist} for network in G_raw}
-		pool = None
-		threads = 1
-		
-		
+	network_list = sorted(G_raw)
+	batch_list = [network_list[num:num+batch_size] for num in xrange(0, len(network_list), batch_size)]
+	null_args = (G_raw, contact_daylist, health_data, node_health, nodelist, time_min, time_max, seed_date, parameter_estimate, diagnosis_lag, recovery_prob, nsick_param, max_recovery_time)
+
+	if threads>1:
+		##the workers hold null_args, only the network keys of each batch are sent
+		start = time.time()
+		pool = start_worker_pool(null_likelihood_worker, null_args, threads)
+		batch_logl = pool.map(pool_worker, batch_list)
+		pool.close()
+		pool.join()
+		nf.record_likelihood_calls("network", np.repeat((time.time()-start)/len(network_list), len(network_list)))
+		nf.record_stage("null_scoring", start)
 	else: 
-		infection_date = None
-		infected_strength=None	
-		threads = 8
-		
+		batch_logl = []
+		for batch in batch_list:
+			start = time.time()
+			batch_logl.append(null_likelihood_worker(null_args, batch))
+			nf.record_likelihood_calls("network", np.repeat((time.time()-start)/len(batch), len(batch)))
+			nf.record_stage("null_scoring", start)
+	
+	logl_list = [logl for logl_batch in batch_logl for logl in logl_batch]
+	return logl_list
 
-	healthy_nodelist = return_healthy_nodelist(node_health)	
-	##############################################################################
+#######################################################################
+def null_likelihood_worker(null_args, batch):
+	r"""null_likelihood_batch for the networks in batch. The networks (and their 
+	contact days) are re-keyed by position in the batch"""
+
+	G_raw, contact_daylist = null_args[:2]
+	G_batch = dict(enumerate([G_raw[network] for network in batch]))
+	contact_batch = None
+	if contact_daylist is not None: contact_batch = dict(contact_daylist, days=contact_daylist['days'][batch], ndays=contact_daylist['ndays'][batch])
+
+	return null_likelihood_batch((G_batch, contact_batch) + null_args[2:])
+
+#######################################################################
+def null_likelihood_batch(batch_args):
+	r"""Log-likelihood of a batch of networks at parameter_estimate. G_batch (and 
+	contact_batch) are keyed by position in the batch. Without diagnosis lag, the
+	networks sharing the same likelihood index are scored together with array operations"""
+
+	G_batch, contact_batch, health_data, node_health, nodelist, time_min, time_max, seed_date, parameter_estimate, diagnosis_lag, recovery_prob, nsick_param, max_recovery_time = batch_args
+
+	infected_strength = calculate_infected_strength_tensor(G_batch, health_data, nodelist, time_min, time_max)
+	likelihood_index = return_likelihood_index(G_batch, health_data, seed_date, time_min, diagnosis_lag)
+
+	if diagnosis_lag:
+		adjacency_stack = return_adjacency_stack(G_batch, nodelist, time_min, time_max)
+		strength_histogram = return_strength_histogram(infected_strength, likelihood_index)
+		data = [G_batch, health_data, node_health, nodelist, None, time_min, time_max, seed_date, parameter_estimate]
+		return [log_likelihood(np.array([num]), data, likelihood_index, infected_strength, strength_histogram, adjacency_stack, True, True, recovery_prob, nsick_param, contact_batch, max_recovery_time, parameter_estimate) for num in sorted(G_batch)]
+
+	p = to_params(np.array([0.]), True, False, nsick_param, recovery_prob, parameter_estimate)
+	##networks with the same first day share the same index arrays
+	index_group = {}
+	for num in sorted(G_batch): index_group.setdefault(id(likelihood_index[num]), []).append(num)
+
+	logl = np.zeros(len(G_batch))
+	for group in index_group.values():
+		learn_position, healthy_position = likelihood_index[group[0]]
+		strength = infected_strength[group].reshape(len(group), -1)
+		overall_learn = np.log(calculate_lambda1(p['beta'][0], p['epsilon'][0], strength[:, learn_position])).sum(axis=1)
+		overall_not_learn = np.log1p(-calculate_lambda1(p['beta'][0], p['epsilon'][0], strength[:, healthy_position])).sum(axis=1)
+		logl[group] = overall_learn + overall_not_learn
+
+	return [-np.inf if (loglike == -np.inf or np.isnan(loglike) or loglike==0) else loglike for loglike in logl]
+
+#######################################################################
+def stream_null_comparison(data, recovery_prob, contact_daylist, max_recovery_time, nsick_param, null_networks, complete_nodelist, is_network_dynamic, diagnosis_lag=False, threads=1, batch_size=50):
+	r"""Compare the network hypothesis (and user supplied null networks in G_raw) with 
+	null_networks randomized networks of G_raw[0]. Each batch of batch_size null networks is 
+	generated, scored and discarded (see null_stream_batch), so memory does not grow with 
+	null_networks. Returns logl_list (as perform_null_comparison) and the jaccard index of
+	each randomized network"""
+
+	G_raw, health_data, node_health, nodelist, true_value,  time_min, time_max, seed_date,parameter_estimate = data
+	logl_list = perform_null_comparison(data, recovery_prob, None, None, False, contact_daylist, max_recovery_time, nsick_param, diagnosis_lag = diagnosis_lag, threads=threads, batch_size=batch_size)
+
+	##each null network is generated from its own seed, so the null networks do not depend on threads
+	seed_list = np.random.randint(2**31-1, size=null_networks)
+	seed_batch_list = (seed_list[num:num+batch_size] for num in xrange(0, null_networks, batch_size))
+	stream_args = (G_raw[0], health_data, node_health, nodelist, time_min, time_max, seed_date, parameter_estimate, complete_nodelist, is_network_dynamic, diagnosis_lag, recovery_prob, nsick_param, max_recovery_time)
 	
-	logl_list = []
-	for network in G_raw:
-		logl = log_likelihood(np.array([network]), data, infection_date, infected_strength, healthy_nodelist, null_comparison, diagnosis_lag,  recovery_prob, nsick_param, contact_daylist, max_recovery_time, parameter_estimate)	
-		
-		logl_list.append(logl)
+	if threads>1:
+		##the workers hold stream_args, only the seeds of each batch are sent
+		pool = start_worker_pool(null_stream_batch, stream_args, threads)
+		batch_result = pool.imap(pool_worker, seed_batch_list)
+	else: batch_result = (null_stream_batch(stream_args, seed_batch) for seed_batch in seed_batch_list)
+
+	jaccard_list = []
+	##generation and scoring times are measured where the batch runs (summed over processes)
+	for logl_batch, jaccard_batch, (generation_time, scoring_time) in batch_result:
+		logl_list.extend(logl_batch)
+		jaccard_list.extend(jaccard_batch)
+		nf.record_stage("null_generation", 0., generation_time)
+		nf.record_stage("null_scoring", 0., scoring_time)
+		nf.record_likelihood_calls("network", np.repeat(scoring_time/len(logl_batch), len(logl_batch)))
+	if threads>1:
+		pool.close()
+		pool.join()
+
+	return logl_list, jaccard_list
+
+#######################################################################
+def null_stream_batch(stream_args, seed_batch):
+	r"""Generates the randomized networks of G, one for each seed in seed_batch, and returns 
+	their log-likelihood (see null_likelihood_batch), jaccard index and the time spent
+	generating and scoring them"""
+
+	G, health_data, node_health, nodelist, time_min, time_max, seed_date, parameter_estimate, complete_nodelist, is_network_dynamic, diagnosis_lag, recovery_prob, nsick_param, max_recovery_time = stream_args
+
+	start = time.time()
+	null_list = null_network_batch((G, complete_nodelist, is_network_dynamic, seed_batch))
+	generated = time.time()
+	G_batch = dict(enumerate([G_null for G_null, jaccard in null_list]))
+	contact_batch = None
+	if diagnosis_lag: contact_batch = nf.return_contact_days_sick_nodes(health_data, seed_date, G_batch, nodelist)
 	
-	return logl_list
+	logl_batch = null_likelihood_batch((G_batch, contact_batch, health_data, node_health, nodelist, time_min, time_max, seed_date, parameter_estimate, diagnosis_lag, recovery_prob, nsick_param, max_recovery_time))
+	return logl_batch, [jaccard for G_null, jaccard in null_list], (generated-start, time.time()-generated)
+
+#######################################################################
+def null_network_batch(batch_args):
+	r"""Randomized networks of G, one for each seed in seed_batch"""
+
+	G, complete_nodelist, is_network_dynamic, seed_batch = batch_args
+	return [nf.randomize_network(G, complete_nodelist, network_dynamic = is_network_dynamic, seed=seed) for seed in seed_batch]
 
 ##############################################3
 def getstate(sampler):
@@ -462,23 +1157,30 @@ def summarize_sampler(sampler, G_raw, true_value, output_filename, summary_type)
 				print ("Printing median and 95% credible interval for the rest of the unknown parameters")
 				print (str(round(CI[num,1],3))+" ["+ str(round(CI[num,0],3))+ "," + str(round(CI[num,2],3))+ "]")
 			
+		start = time.time()
 		fig = corner.corner(sampler.flatchain[0, :, 0:2], quantiles=[0.16, 0.5, 0.84], labels=["$beta$", "$epsilon$"], truths= true_value, truth_color ="red")
 			
 		fig.savefig(output_filename + "_" + summary_type +"_posterior.png")
 		nf.plot_beta_results(sampler, filename = output_filename + "_" + summary_type +"_beta_walkers.png" )
-		logz, logzerr = log_evidence(sampler)
+		start = nf.record_stage("plotting", start)
+		##accumulated during sampling (see update_evidence_state)
+		(logz, logzerr), (logz_ss, logzerr_ss) = return_evidence(sampler.evidence_state, sampler.betas)
 		evidence = np.exp(logz)
 		error = evidence*logzerr
 		print ("Log Bayes evidence and error"), logz, logzerr
+		print ("Stepping-stone log Bayes evidence and error"), logz_ss, logzerr_ss
+		print ("Swap acceptance between adjacent temperatures"), np.round(return_swap_acceptance(sampler.nswap_accepted, sampler.nswap), 3)
 		print ("Transformed evidence and error"), evidence, error
 		autocor_checks(sampler, output_filename)
+		nf.record_stage("plotting", start)
 		cPickle.dump(getstate(sampler), open( output_filename + "_" + summary_type +  ".p", "wb" ), protocol=2)
+		return CI
  
 	
 	#################################
 	if summary_type =="null_comparison":
 		best_par = None
-		N_networks = len(G_raw)
+		N_networks = len(sampler)
 		sampler_null = sampler[1:]
 		df = pd.DataFrame(sampler)
 		file_name = output_filename + "_" + summary_type +  ".csv"
@@ -487,9 +1189,11 @@ def summarize_sampler(sampler, G_raw, true_value, output_filename, summary_type)
 			ha = sampler[0]
 			nulls = sampler[1:]
 			ext_val = [int(num>=ha) for num in nulls]
-			print ("p-value of network hypothesis"), sum(ext_val)/(1.*len(ext_val))
+			p_value = sum(ext_val)/(1.*len(ext_val))
+			print ("p-value of network hypothesis"), p_value
 			ind = [num for num in xrange(N_networks)]
 			
+			start = time.time()
 			########pretty matplotlib figure format
 			axis_font = {'fontname':'Arial', 'size':'16'}
 			plt.clf()
@@ -507,11 +1211,105 @@ def summarize_sampler(sampler, G_raw, true_value, output_filename, summary_type)
 			plt.legend()
 			plt.legend(frameon=False)
 			plt.savefig(output_filename + "_" + summary_type +"_posterior.png")
-	return CI	
+			nf.record_stage("plotting", start)
+			return p_value
 	
+#######################################################################
+def read_input_data(edge_filename, health_filename, infection_type, complete_nodelist, edge_weights_to_binary, normalize_edge_weight, diagnosis_lag, is_network_dynamic, cache_dir=None):
+	r"""Reads and preprocesses the network and health files. Returns a dictionary with 
+	keys G_raw, nodelist, health_data, node_health, time_max, seed_date, infected_strength 
+	(of the network hypothesis, shape (1 x nodes x timesteps)), contact_daylist and 
+	max_recovery_time (None if not needed). If cache_dir is given, the preprocessed arrays
+	are saved there (see nf.save_cache) and later runs on the same files and settings load 
+	them memory-mapped instead"""
+
+	recovery_prob = nf.can_nodes_recover(infection_type)
+	if complete_nodelist is not None: complete_nodelist = sorted(set(str(num) for num in complete_nodelist))
+	cache_path = None
+	if cache_dir is not None:
+		settings = (infection_type.upper()[-1]=="R", recovery_prob, complete_nodelist, edge_weights_to_binary, normalize_edge_weight, diagnosis_lag, is_network_dynamic)
+		cache_path = nf.return_cache_path(cache_dir, [edge_filename, health_filename], settings)
+		start = time.time()
+		arrays = nf.load_cache(cache_path)
+		if arrays is not None: 
+			inputs = arrays_to_input_data(arrays, is_network_dynamic)
+			nf.record_stage("cache_load", start)
+			return inputs
+
+	inputs = {}
+	start = time.time()
+	inputs['time_max'] = time_max = nf.extract_maxtime(edge_filename, health_filename)
+	nf.record_stage("file_load", start)
+	G, nodelist = nf.create_dynamic_network(edge_filename, complete_nodelist, edge_weights_to_binary, normalize_edge_weight, is_network_dynamic, time_max)
+	inputs['G_raw'], inputs['nodelist'] = {0: G}, nodelist
+	inputs['health_data'], inputs['node_health'] = nf.extract_health_data(health_filename, infection_type, nodelist, time_max, diagnosis_lag)
+	#find the first time-period when an infection was reported 
+	inputs['seed_date'] = nf.find_seed_date(inputs['node_health'])
+	start = time.time()
+	inputs['infected_strength'] = calculate_infected_strength_tensor(inputs['G_raw'], inputs['health_data'], nodelist, 0, time_max)
+	start = nf.record_stage("infected_strength", start)
+	
+	inputs['contact_daylist'], inputs['max_recovery_time'] = None, None
+	#Format: contact_daylist['days'][network_type, sick case] = padded array of the
+	## potential time-points when the node could have contract infection (see nf.return_contact_days_sick_nodes)
+	if diagnosis_lag: inputs['contact_daylist'] = nf.return_contact_days_sick_nodes(inputs['health_data'], inputs['seed_date'], inputs['G_raw'], nodelist)
+	if diagnosis_lag and recovery_prob: inputs['max_recovery_time'] = nf.return_potention_recovery_date(inputs['health_data'], inputs['contact_daylist']['sick_cases'], time_max)	
+	if diagnosis_lag: start = nf.record_stage("contact_days", start)
+
+	if cache_path is not None: 
+		nf.save_cache(cache_path, input_data_to_arrays(inputs))
+		nf.record_stage("cache_save", start)
+	return inputs
+
+#######################################################################
+def input_data_to_arrays(inputs):
+	r"""Array form of the preprocessed data returned by read_input_data (see nf.save_cache)"""
+
+	nodelist, G = inputs['nodelist'], inputs['G_raw'][0]
+	network = nf.stack_adjacency(G, len(nodelist), min(G), max(G))
+	arrays = {'time_max': np.array(inputs['time_max']), 'seed_date': np.array(inputs['seed_date']), 'nodelist': np.array(nodelist),
+		'infected_strength': inputs['infected_strength'], 'network_times': np.array([min(G), max(G)]),
+		'network_data': network.data, 'network_indices': network.indices, 'network_indptr': network.indptr}
+	for key in inputs['health_data']: arrays['health_' + key] = inputs['health_data'][key]
+	if inputs['contact_daylist'] is not None: 
+		for key in inputs['contact_daylist']: arrays['contact_' + key] = inputs['contact_daylist'][key]
+	if inputs['max_recovery_time'] is not None: arrays['max_recovery_time'] = inputs['max_recovery_time']
+
+	return arrays
+
+#######################################################################
+def arrays_to_input_data(arrays, is_network_dynamic):
+	r"""Inverse of input_data_to_arrays"""
+
+	inputs = {}
+	inputs['time_max'], inputs['seed_date'] = int(arrays['time_max']), int(arrays['seed_date'])
+	inputs['nodelist'] = nodelist = arrays['nodelist'].tolist()
+	n_nodes = len(nodelist)
+	time_start, time_end = arrays['network_times'].tolist()
+	network = sparse.csr_matrix((arrays['network_data'], arrays['network_indices'], arrays['network_indptr']), shape=(len(arrays['network_indptr'])-1, n_nodes))
+	inputs['G_raw'] = {0: nf.return_network_slices(network, n_nodes, time_start, time_end, is_network_dynamic, inputs['time_max'])}
+	inputs['health_data'] = {key[len('health_'):]: arrays[key] for key in arrays if key.startswith('health_')}
+	inputs['node_health'] = nf.return_node_health(inputs['health_data'], nodelist)
+	inputs['infected_strength'] = arrays['infected_strength']
+
+	inputs['contact_daylist'], inputs['max_recovery_time'] = None, None
+	if 'contact_sick_cases' in arrays: inputs['contact_daylist'] = {key[len('contact_'):]: arrays[key] for key in arrays if key.startswith('contact_')}
+	if 'max_recovery_time' in arrays: inputs['max_recovery_time'] = arrays['max_recovery_time']
+
+	return inputs
+
 ######################################################################33
-def run_inods_sampler(edge_filename, health_filename, output_filename, infection_type,  null_networks = 500, burnin =1000, iteration=2000, truth = None, verbose=True, complete_nodelist = None, null_comparison=False,  edge_weights_to_binary=False, normalize_edge_weight=False, diagnosis_lag=False, is_network_dynamic=True, parameter_estimate=True, compare_asocial_social_force =True):
-	r"""Main function for INoDS """
+def run_inods_sampler(edge_filename, health_filename, output_filename, infection_type,  null_networks = 500, burnin =1000, iteration=2000, truth = None, verbose=True, complete_nodelist = None, null_comparison=False,  edge_weights_to_binary=False, normalize_edge_weight=False, diagnosis_lag=False, is_network_dynamic=True, parameter_estimate=True, compare_asocial_social_force =True, threads=1, checkpoint_interval=None, resume=False, target_ess=None, adaptive_ladder=False, cache_dir=None):
+	r"""Main function for INoDS. threads = number of processes used by the diagnosis lag 
+	sampler and to score the null networks. The parameter estimation is checkpointed to 
+	output_filename_checkpoint.p every checkpoint_interval iterations, resume = True continues
+	from the last checkpoint. If target_ess is given, burn-in and sampling stop early once 
+	each parameter has target_ess independent samples. adaptive_ladder = True tunes the 
+	temperature ladder during burn-in. If cache_dir is given, the preprocessed input data
+	is cached there and reused by runs on the same files and settings (see read_input_data).
+	Stage timings, likelihood latencies and sampler acceptance rates are written to 
+	output_filename_instrumentation.json (see write_run_report). Returns a dictionary of 
+	the results (see INoDS_batch.summarize_results)"""
 	
 	###########################################################################
 	##health_data is the raw dictionary. The structure of dictionary:         # 
@@ -521,61 +1319,51 @@ def run_inods_sampler(edge_filename, health_filename, output_filename, infection
 	## node_health[node id][infection status] = tuple of (min, max) time      #
 	## period when the node is in the infection status                        #
 	###########################################################################
+	nf.start_instrumentation()
 	#Can nodes recover?
 	recovery_prob = nf.can_nodes_recover(infection_type)
 	time_min = 0
-	time_max = nf.extract_maxtime(edge_filename, health_filename)
-
-	G_raw = {}
-	## read in the dynamic network hypthosis (HA)
-	G_raw[0] = nf.create_dynamic_network(edge_filename, complete_nodelist, edge_weights_to_binary, normalize_edge_weight, is_network_dynamic, time_max)
-	nodelist = nf.extract_nodelist(G_raw[0])
-	
-	health_data, node_health = nf.extract_health_data(health_filename, infection_type, nodelist, time_max, diagnosis_lag)
-	#find the first time-period when an infection was reported 
-	seed_date = nf.find_seed_date(node_health)
-
-	
-	contact_daylist = None
-	max_recovery_time = None	
+	## read in the dynamic network hypthosis (HA) and the health data
+	inputs = read_input_data(edge_filename, health_filename, infection_type, complete_nodelist, edge_weights_to_binary, normalize_edge_weight, diagnosis_lag, is_network_dynamic, cache_dir)
+	G_raw, nodelist, health_data, node_health = inputs['G_raw'], inputs['nodelist'], inputs['health_data'], inputs['node_health']
+	time_max, seed_date = inputs['time_max'], inputs['seed_date']
+
+	#Format: contact_daylist['days'][network_type, sick case] = padded array of the
+	## potential time-points when the node could have contract infection 
+	contact_daylist = inputs['contact_daylist']
+	max_recovery_time = inputs['max_recovery_time']
 	nsick_param = 0
+	if diagnosis_lag: nsick_param = len(contact_daylist['sick_cases'])
+	results = {}
+	sampler = None
 	##########################################################################
 	if parameter_estimate:
 	##Step 1: Estimate unknown parameters of network hypothesis HA.
-		if diagnosis_lag:
-			#Format: contact_daylist[network_type][(node, time1, time2)] =       
-			## potential time-points when the node could have contract infection 
-			contact_daylist = nf.return_contact_days_sick_nodes(node_health, seed_date, G_raw)
-			nsick_param = len(contact_daylist[0])
-		
-		if recovery_prob: max_recovery_time = nf.return_potention_recovery_date(node_health, time_max)	
-
 		true_value = truth
 		data1 = [G_raw, health_data, node_health, nodelist, true_value,  time_min, time_max, seed_date]
 
 		print ("estimating model parameters.........................")
 		start = time.time()
-		sampler = start_sampler(data1,  recovery_prob,  burnin, iteration, verbose,  contact_daylist, max_recovery_time, nsick_param, diagnosis_lag = diagnosis_lag)
+		sampler = start_sampler(data1,  recovery_prob,  burnin, iteration, verbose,  contact_daylist, max_recovery_time, nsick_param, diagnosis_lag = diagnosis_lag, threads=threads, 
+			checkpoint_filename = output_filename + "_checkpoint.p", checkpoint_interval=checkpoint_interval, resume=resume, target_ess=target_ess, adaptive_ladder=adaptive_ladder, 
+			infected_strength=inputs['infected_strength'])
 		summary_type = "parameter_estimate"
 		CI = summarize_sampler(sampler, G_raw, true_value, output_filename, summary_type)
 		best_par = np.array([CI[num,1] for num in xrange(CI.shape[0])])
+		results['CI'] = CI
+		results['log_evidence'], results['stepping_stone_evidence'] = return_evidence(sampler.evidence_state, sampler.betas)
 		print ("time==="), time.time() - start
 		##################################################################
 	if compare_asocial_social_force:	
 
 		if not parameter_estimate: best_par = np.array(truth)
 
-		if diagnosis_lag:
-			#Format: contact_daylist[network_type][(node, time1, time2)] =       
-			## potential time-points when the node could have contract infection 
-			contact_daylist = nf.return_contact_days_sick_nodes(node_health, seed_date, G_raw)
-			nsick_param = len(contact_daylist[0])
-		
-		if recovery_prob: max_recovery_time = nf.return_potention_recovery_date(node_health, time_max)	
-
 		data1 = [G_raw, health_data, node_health, nodelist, truth,  time_min, time_max, seed_date]
-		epsilon_dominant = compare_asocial_social_rate(best_par, data1, contact_daylist, diagnosis_lag, recovery_prob, nsick_param, max_recovery_time, time_min, time_max)
+		start = time.time()
+		epsilon_dominant = compare_asocial_social_rate(best_par, data1, contact_daylist, diagnosis_lag, recovery_prob, nsick_param, max_recovery_time, time_min, time_max, inputs['infected_strength'][0])
+		nf.record_stage("asocial_social_comparison", start)
 		print ("proportion of times asocial force > social force = "), epsilon_dominant
+		results['epsilon_dominant'] = epsilon_dominant
 		
 	#############################################################################
 	if not parameter_estimate and sum(truth)==0:
@@ -585,43 +1373,60 @@ def run_inods_sampler(edge_filename, health_filename, output_filename, infection
 	##Step 2: Perform hypothesis testing by comparing HA against null networks
 	if null_comparison:
 		if parameter_estimate:	
-			parameter_estimate =  summary(sampler)
+			##median estimate of the network hypothesis
+			parameter_estimate =  best_par
 		else:
 			parameter_estimate = truth
 
 		if isinstance(null_networks, dict):
 			for (num,val) in enumerate(null_networks):
-				G_raw[num+1] = null_networks[val]	
+				G_raw[num+1] = nf.network_to_adjacency(null_networks[val], nf.return_node_index(nodelist))
 			
 			
-		if isinstance(null_networks, int):
-			print ("generating null graphs.......")
-			jaccard_list =[]
-			for num in xrange(null_networks): 
-				if verbose: print ("generating null network ="), num
-				G_raw[num+1], jaccard = nf.randomize_network(G_raw[0], complete_nodelist,network_dynamic = is_network_dynamic)
-				jaccard_list.append(jaccard)
-			if np.mean(jaccard_list)>0.4: 
-				print ("Warning!! Randomized network resembles empircal network. May lead to inconsistent evidence")
-		
 		true_value = truth
 		data1 = [G_raw, health_data, node_health, nodelist, true_value, time_min, time_max, seed_date, parameter_estimate]
 
-		if diagnosis_lag:
-			#Format: contact_daylist[network_type][(node, time1, time2)] =       
-			## potential time-points when the node could have contract infection 
-			contact_daylist = nf.return_contact_days_sick_nodes(node_health, seed_date, G_raw)
-			nsick_param = len(contact_daylist[0])
+		##contact days of the user supplied null networks
+		if diagnosis_lag and len(G_raw)>1: 
+			start = time.time()
+			contact_daylist = nf.return_contact_days_sick_nodes(health_data, seed_date, G_raw, nodelist)
+			nf.record_stage("contact_days", start)
 
-		if recovery_prob: max_recovery_time = nf.return_potention_recovery_date(node_health, time_max)	
 		print ("comparing network hypothesis with null..........................")
 
 
-	
-		logl_list = perform_null_comparison(data1, recovery_prob, burnin,  iteration,  verbose, contact_daylist, max_recovery_time, nsick_param, diagnosis_lag = diagnosis_lag, null_networks=null_networks)
+		if isinstance(null_networks, int):
+			##null networks are generated and scored in batches, without storing them in G_raw
+			print ("generating null graphs.......")
+			logl_list, jaccard_list = stream_null_comparison(data1, recovery_prob, contact_daylist, max_recovery_time, nsick_param, null_networks, complete_nodelist, is_network_dynamic, diagnosis_lag = diagnosis_lag, threads=threads)
+			if verbose: print ("generated null networks ="), len(jaccard_list)
+			if np.mean(jaccard_list)>0.4: 
+				print ("Warning!! Randomized network resembles empircal network. May lead to inconsistent evidence")
+		else:
+			logl_list = perform_null_comparison(data1, recovery_prob, burnin,  iteration,  verbose, contact_daylist, max_recovery_time, nsick_param, diagnosis_lag = diagnosis_lag, null_networks=null_networks, threads=threads)
 		summary_type = "null_comparison"
-		summarize_sampler(logl_list, G_raw, true_value, output_filename, summary_type)
+		results['p_value'] = summarize_sampler(logl_list, G_raw, true_value, output_filename, summary_type)
+		results['null_loglikelihood'] = logl_list
 	##############################################################################
+	settings = {'infection_type': infection_type, 'diagnosis_lag': diagnosis_lag, 'threads': threads, 'nodes': len(nodelist), 
+		'time_max': time_max, 'sick_cases': nsick_param, 'null_networks': null_networks if isinstance(null_networks, int) else len(null_networks)}
+	results['instrumentation'] = write_run_report(output_filename + "_instrumentation.json", sampler, settings)
+	return results
+
+#######################################################################
+def write_run_report(filename, sampler, settings):
+	r"""Writes the json instrumentation report of the run (see nf.write_instrumentation): 
+	time per stage, likelihood calls and latency histograms (per walker evaluation and per
+	scored network), the run settings and, if parameters were estimated, the acceptance 
+	fraction of the walkers and the swap acceptance of each temperature"""
+
+	extra = {'settings': settings, 'sampler': None}
+	if sampler is not None:
+		extra['sampler'] = {'ntemps': sampler.ntemps, 'nwalkers': sampler.nwalkers, 'betas': sampler.betas.tolist(), 
+			'acceptance_fraction': sampler.acceptance_fraction.mean(axis=1).tolist(), 
+			'swap_acceptance_fraction': sampler.tswap_acceptance_fraction.tolist(),
+			'adjacent_swap_acceptance': return_swap_acceptance(sampler.nswap_accepted, sampler.nswap).tolist()}
+	return nf.write_instrumentation(filename, extra)
 
 
 ######################################################################33
@@ -1,53 +1,155 @@
-from emcee import PTSampler
 import numpy as np
-#from emcee.autocorr import AutocorrError, function
 ############################################################
+def fast_length(n):
+    """Smallest FFT length ``>= n`` whose only prime factors are 2, 3 and 5.
+    """
+    best = 2 ** int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            # Smallest power of two times p35 that is at least n.
+            p2 = p35
+            while p2 < n:
+                p2 *= 2
+            best = min(best, p2)
+            p35 *= 3
+        p5 *= 5
+    return best
+
 def function(w, axis=0, fast=False):
     """Estimate the autocorrelation function of a time series using the FFT.
     Args:
         w: The time series. If multidimensional, set the time axis using the
             ``axis`` keyword argument and the function will be computed for
-            every other axis.
+            every other axis with a single FFT.
         axis (Optional[int]): The time axis of ``x``. Assumed to be the first
             axis if not specified.
-        fast (Optional[bool]): If ``True``, only use the first ``2^n`` (for
-            the largest power) entries for efficiency. (default: False)
+        fast (Optional[bool]): Kept for compatibility. The series is always
+            zero-padded to a fast FFT length (see :func:`fast_length`), which
+            does not change the result.
     Returns:
         array: The autocorrelation function of the time series.
     """
     w = np.atleast_1d(w)
-    m = [slice(None), ] * len(w.shape)
-
     n = w.shape[axis]
-   
+    # Padding to at least 2n avoids the circular wrap-around.
+    nfft = fast_length(2 * n)
+
     # Compute the FFT and then (from that) the auto-correlation function.
-    f = np.fft.fft(w - np.mean(w, axis=axis), n=2*n, axis=axis)
-    m[axis] = slice(0, n)
-    acf = np.fft.ifft(f * np.conjugate(f), axis=axis)[m].real
-    m[axis] = 0
-    print ("check 2!!"), acf, acf[m]
-    return acf / acf[m]
-
-def get_autocorr_time(sampler, min_step=0,  chain=[], **kwargs):
+    f = np.fft.rfft(w - np.mean(w, axis=axis, keepdims=True), n=nfft,
+                    axis=axis)
+    acf = np.fft.irfft(f.real ** 2 + f.imag ** 2, n=nfft, axis=axis)
+    acf = np.take(acf, np.arange(n), axis=axis)
+    return acf / np.take(acf, [0], axis=axis)
+
+def walker_function(chain, chunk_size=16):
+    """Autocorrelation function of each parameter of ``chain`` (shape
+    ``(..., nwalkers, nsteps, ndim)``), averaged over the walkers.
+
+    The walkers are transformed ``chunk_size`` at a time, so the memory used
+    by the FFT stays proportional to the chunk. Walkers that never moved have
+    no autocorrelation function and are left out of the average.
+
+    Returns:
+        array: Shape ``(..., nsteps, ndim)``.
+    """
+    chain = np.asarray(chain)
+    nwalkers = chain.shape[-3]
+    total = np.zeros(chain.shape[:-3] + chain.shape[-2:])
+    count = np.zeros(total.shape)
+    for start in range(0, nwalkers, chunk_size):
+        acf = function(chain[..., start:start + chunk_size, :, :], axis=-2)
+        valid = np.isfinite(acf)
+        total += np.where(valid, acf, 0).sum(axis=-3)
+        count += valid.sum(axis=-3)
+    return total / count
+
+def window_taus(f, low=10, high=None, step=1, axis=0):
+    """Integrated autocorrelation time of ``f`` for every window size in
+    ``range(low, high, step)``, computed from one cumulative sum.
+
+    An anti-correlated (tau < 1) chain is counted as independent.
+
+    Returns:
+        array: The window sizes.
+        array: The autocorrelation times, with the window along the first
+            axis followed by the other axes of ``f``.
+    """
+    f = np.moveaxis(f, axis, 0)
+    if high is None:
+        high = f.shape[0]
+    windows = np.arange(low, min(high, f.shape[0] + 1), step).astype(int)
+    # csum[M - 1] is the sum of f[1:M].
+    csum = np.cumsum(f, axis=0) - f[0]
+    tau = np.maximum(1 + 2 * csum[windows - 1], 1.0)
+    return windows, tau
+
+def window_time(f, size, low=10, high=None, step=1, c=2, full_output=False,
+            axis=0):
+    """Integrated autocorrelation time from the autocorrelation function
+    ``f`` of a chain of length ``2*size``, using the window search of
+    :func:`integrated_time`. The window is shared by all the series in ``f``.
+    """
+    if high is None:
+        high = int(size / c)
+    windows, tau = window_taus(f, low=low, high=high, step=step, axis=axis)
+    taumax = tau.reshape((len(windows), -1)).max(axis=1)
+
+    # Accept the first window size that satisfies the convergence criterion,
+    # unless the autocorrelation time became too long to be estimated
+    # reliably from the chain at a smaller window.
+    accept = windows > c * taumax
+    stop = accept | (c * taumax >= size)
+    if stop.any() and accept[stop.argmax()]:
+        i = stop.argmax()
+        if full_output:
+            return tau[i], windows[i]
+        return tau[i]
+
+    raise ValueError("The chain is too short to reliably estimate "
+                        "the autocorrelation time")
+
+def series_window_time(f, size, low=10, high=None, step=1, c=2, axis=0):
+    """Integrated autocorrelation time of each series in ``f`` (the
+    autocorrelation function of a chain of length ``2*size``), with the
+    window search of :func:`window_time` run separately, and vectorized,
+    for every series.
+
+    Returns:
+        array: The autocorrelation times (shape of ``f`` without ``axis``),
+            ``nan`` where the chain is too short for a reliable estimate.
+        array: The window sizes, ``0`` where the estimate failed.
+    """
+    if high is None:
+        high = int(size / c)
+    windows, tau = window_taus(f, low=low, high=high, step=step, axis=axis)
+    shape = tau.shape[1:]
+    if len(windows) == 0:
+        return np.nan * np.ones(shape), np.zeros(shape, dtype=int)
+    windows = windows.reshape((-1,) + (1,) * len(shape))
+
+    accept = windows > c * tau
+    stop = accept | (c * tau >= size)
+    i = stop.argmax(axis=0)
+    found = np.take_along_axis(accept, i[None], axis=0)[0]
+    tau = np.where(found, np.take_along_axis(tau, i[None], axis=0)[0], np.nan)
+    return tau, np.where(found, windows.ravel()[i], 0)
+
+def get_autocorr_time(sampler, min_step=0, chain=None, **kwargs):
         """Return a matrix of autocorrelation lengths.
 
         Returns a matrix of autocorrelation lengths for each
-        parameter in each temperature of shape ``(Ntemps, Ndim)``.
-        Any arguments will be passed to :func:`autocorr.integrate_time`.
+        parameter in each temperature of shape ``(Ntemps, Ndim)``, from a
+        single FFT over the chain (see :func:`walker_autocorr_time`).
+        ``chain`` replaces ``sampler.chain`` if given. Entries that cannot
+        be estimated reliably are ``nan``. Any arguments will be passed to
+        :func:`series_window_time`.
         """
-	ntemps, nwalkers, nsteps, ndim = sampler.chain.shape
-        acors = np.zeros((ntemps, ndim))
-
-        for i in range(ntemps):
-            acors[i, :] = 0.0
-            x = sampler.chain[i, :, min_step:, :]
-	    print ("running for"), i, len(x)
-            for w in x:
-		autocor = integrated_time(sampler,w, **kwargs)
-		print ("autocor"), autocor
-                acors[i, :] += autocor
-            acors[i, :] /= len(x)
-        return acors
+        if chain is None:
+            chain = sampler.chain
+        return walker_autocorr_time(chain[:, :, min_step:, :],
+                                    full_output=True, **kwargs)[0]
 
 def integrated_time(sampler,w, low=10, high=None, step=1, c=2, full_output=False,
             axis=0, fast=False):
@@ -68,13 +170,13 @@ def integrated_time(sampler,w, low=10, high=None, step=1, c=2, full_output=False
             step (Optional[int]): The step size for the window search.
                 (default: ``1``)
             c (Optional[float]): The minimum number of autocorrelation times
-                needed to trust the estimate. (default: ``10``)
+                needed to trust the estimate. (default: ``2``)
             full_output (Optional[bool]): Return the final window size as well
                 as the autocorrelation time. (default: ``False``)
             axis (Optional[int]): The time axis of ``x``. Assumed to be the
                 first axis if not specified.
-            fast (Optional[bool]): If ``True``, only use the first ``2^n`` (for
-                the largest power) entries for efficiency. (default: False)
+            fast (Optional[bool]): Kept for compatibility, see
+                :func:`function`.
 
         Returns:
             float or array: An estimate of the integrated autocorrelation time
@@ -83,47 +185,48 @@ def integrated_time(sampler,w, low=10, high=None, step=1, c=2, full_output=False
                 if ``full_output`` is ``True``.
 
         Raises
-            AutocorrError: If the autocorrelation time can't be reliably
+            ValueError: If the autocorrelation time can't be reliably
                 estimated from the chain. This normally means that the chain
                 is too short.
 
         """
         size = 0.5 * w.shape[axis]
         if int(c * low) >= size:
-	    raise ValueError("The chain is too short")
+            raise ValueError("The chain is too short")
 
         # Compute the autocorrelation function.
         f = function(w, axis=axis, fast=fast)
+        return window_time(f, size, low=low, high=high, step=step, c=c,
+                           full_output=full_output, axis=axis)
 
-        # Check the dimensions of the array.
-        oned = len(f.shape) == 1
-        m = [slice(None), ] * len(f.shape)
-	
-        # Loop over proposed window sizes until convergence is reached.
-        if high is None:
-            high = int(size / c)
-        for M in np.arange(low, high, step).astype(int):
-            # Compute the autocorrelation time with the given window.
-	    
-            if oned:
-                # Special case 1D for simplicity.
-                tau = 1 + 2 * np.sum(f[1:M])
-            else:
-                # N-dimensional case.
-                m[axis] = slice(1, M)
-                tau = 1 + 2 * np.sum(f[m], axis=axis)
-	    print ("check!!"), low, high, M, tau, np.all(tau > 1.0), c*tau.max(), M > c * tau.max(), np.sum(f[m], axis=axis)
-            # Accept the window size if it satisfies the convergence criterion.
-            if np.all(tau > 1.0) and M > c * tau.max():
-		print ("this should work")
-                if full_output:
-                    return tau, M
-                return tau
-
-            # If the autocorrelation time is too long to be estimated reliably
-            # from the chain, it should fail.
-            if c * tau.max() >= size:
-                break
+def walker_autocorr_time(chain, full_output=False, **kwargs):
+    """Integrated autocorrelation time of each parameter of ``chain`` (shape
+    ``(..., nwalkers, nsteps, ndim)``, e.g. the whole tempered chain). The
+    autocorrelation function is averaged over the walkers before the window
+    search, which is less noisy than averaging the time of each walker. Any
+    arguments will be passed to :func:`series_window_time`.
 
+    Returns:
+        array: Shape ``(..., ndim)``.
+        Optional[array]: The window sizes, only returned if ``full_output``
+            is ``True``; then entries that cannot be estimated are ``nan``
+            instead of raising.
+
+    Raises
+        ValueError: If the autocorrelation time of any parameter can't be
+            reliably estimated from the chain.
+    """
+    size = 0.5 * chain.shape[-2]
+    if int(kwargs.get('c', 2) * kwargs.get('low', 10)) >= size:
+        if full_output:
+            shape = chain.shape[:-3] + chain.shape[-1:]
+            return np.nan * np.ones(shape), np.zeros(shape, dtype=int)
+        raise ValueError("The chain is too short")
+    f = walker_function(chain)
+    tau, windows = series_window_time(f, size, axis=-2, **kwargs)
+    if full_output:
+        return tau, windows
+    if np.isnan(tau).any():
         raise ValueError("The chain is too short to reliably estimate "
                             "the autocorrelation time")
+    return tau
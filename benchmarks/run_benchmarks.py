@@ -0,0 +1,176 @@
+import sys
+import os
+sys.path = [os.path.abspath(os.path.join(__file__, '..', '..')), os.path.abspath(os.path.join(__file__, '..'))] + sys.path
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+import numpy as np
+import pandas as pd
+import INoDS_model as inods
+import INoDS_convenience_functions as nf
+import synthetic_data as sd
+##################################################
+## Scaling benchmarks of INoDS on synthetic data (see synthetic_data.py).
+## Every run appends one row per (dataset, stage) to the results file, with
+## the commit of the repository, so the timings of different versions can
+## be compared (see compare_results). Example:
+## $ python run_benchmarks.py --nodes 100 1000 10000 --timesteps 10 100 --types SI SIR
+##################################################
+
+##benchmarked stages (in the order they are reported) and columns of the results file
+stage_order = ['create_dynamic_network', 'extract_health_data', 'infected_strength', 'contact_days', 'log_likelihood', 'randomize_network', 'perform_null_comparison']
+result_columns = ['timestamp', 'commit', 'nodes', 'timesteps', 'infection_type', 'diagnosis_lag', 'edges', 'infected', 'sick_cases', 'stage', 'calls', 'seconds', 'min_seconds', 'repeat']
+
+##############################################################################
+def time_stage(function, repeat, calls=1):
+	r"""Runs function repeat*calls times. Returns the last result and the median and
+	minimum (over the repeats) of the time per call"""
+
+	timings = []
+	for num in xrange(repeat):
+		start = time.time()
+		for num1 in xrange(calls): result = function()
+		timings.append((time.time() - start)/calls)
+	return result, np.median(timings), min(timings)
+
+##############################################################################
+def benchmark_dataset(edge_filename, health_filename, infection_type, diagnosis_lag, repeat=3, likelihood_calls=20, null_networks=10, seed=None):
+	r"""Times the INoDS stages on one dataset: reading the network (create_dynamic_network),
+	reading the health data (extract_health_data), the infected strength precompute,
+	the contact days of the sick cases (with diagnosis lag only), log_likelihood at random
+	parameters, randomize_network and perform_null_comparison of the network against
+	null_networks randomized networks. Returns {stage: (calls, median, minimum seconds per call)}
+	and the number of sick cases"""
+
+	rng = np.random.RandomState(seed)
+	recovery_prob = nf.can_nodes_recover(infection_type)
+	timing = {}
+	time_max = nf.extract_maxtime(edge_filename, health_filename)
+	(G, nodelist), median, minimum = time_stage(lambda: nf.create_dynamic_network(edge_filename, None, False, False, True, time_max), repeat)
+	timing['create_dynamic_network'] = (1, median, minimum)
+	(health_data, node_health), median, minimum = time_stage(lambda: nf.extract_health_data(health_filename, infection_type, nodelist, time_max, diagnosis_lag), repeat)
+	timing['extract_health_data'] = (1, median, minimum)
+	seed_date = nf.find_seed_date(node_health)
+
+	G_raw = {0: G}
+	infected_strength, median, minimum = time_stage(lambda: inods.calculate_infected_strength_tensor(G_raw, health_data, nodelist, 0, time_max), repeat)
+	timing['infected_strength'] = (1, median, minimum)
+
+	##log-likelihood arguments as set up by start_sampler
+	likelihood_index = inods.return_likelihood_index(G_raw, health_data, seed_date, 0, diagnosis_lag)
+	strength_histogram = inods.return_strength_histogram(infected_strength, likelihood_index)
+	contact_daylist, max_recovery_time, adjacency_stack, nsick_param = None, None, None, 0
+	if diagnosis_lag:
+		contact_daylist, median, minimum = time_stage(lambda: nf.return_contact_days_sick_nodes(health_data, seed_date, G_raw, nodelist), repeat)
+		timing['contact_days'] = (1, median, minimum)
+		nsick_param = len(contact_daylist['sick_cases'])
+		if recovery_prob: max_recovery_time = nf.return_potention_recovery_date(health_data, contact_daylist['sick_cases'], time_max)
+		adjacency_stack = inods.return_adjacency_stack(G_raw, nodelist, 0, time_max)
+		loglargs = (likelihood_index, infected_strength, strength_histogram, adjacency_stack)
+	else: loglargs = (None, None, strength_histogram, None)
+
+	ndim = 2 + (nsick_param if diagnosis_lag and recovery_prob else 0) + nsick_param
+	parameters = np.concatenate([[0.1, 0.001], rng.uniform(0.001, 1, size=ndim-2)])
+	data = [G_raw, health_data, node_health, nodelist, None, 0, time_max, seed_date]
+	loglike, median, minimum = time_stage(lambda: inods.log_likelihood(parameters, data, *(loglargs + (False, diagnosis_lag, recovery_prob, nsick_param, contact_daylist, max_recovery_time, None))), repeat, likelihood_calls)
+	timing['log_likelihood'] = (likelihood_calls, median, minimum)
+
+	seed_list = iter(rng.randint(2**31-1, size=repeat*null_networks))
+	null_list, median, minimum = time_stage(lambda: [nf.randomize_network(G, None, network_dynamic=True, seed=next(seed_list))[0] for num in xrange(null_networks)], repeat)
+	timing['randomize_network'] = (null_networks, median/null_networks, minimum/null_networks)
+
+	for num, G_null in enumerate(null_list): G_raw[num+1] = G_null
+	if diagnosis_lag: contact_daylist = nf.return_contact_days_sick_nodes(health_data, seed_date, G_raw, nodelist)
+	data = [G_raw, health_data, node_health, nodelist, None, 0, time_max, seed_date, parameters]
+	logl_list, median, minimum = time_stage(lambda: inods.perform_null_comparison(data, recovery_prob, None, None, False, contact_daylist, max_recovery_time, nsick_param, diagnosis_lag=diagnosis_lag), repeat)
+	timing['perform_null_comparison'] = (len(G_raw), median, minimum)
+
+	return timing, nsick_param
+
+##############################################################################
+def return_commit():
+	r"""Short hash of the checked out commit of the repository (None outside git)"""
+
+	try: return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, "w")).strip()
+	except (OSError, subprocess.CalledProcessError): return None
+
+##############################################################################
+def run_benchmarks(nodes, timesteps, infection_types, lags, results_filename, repeat=3, likelihood_calls=20, null_networks=10, mean_degree=4., max_node_days=10**7, data_dir=None, seed=0):
+	r"""Benchmarks every combination of network size (nodes x timesteps), infection type and
+	diagnosis lag (None = no lag, else mean lag in timesteps). Datasets with more than
+	max_node_days node-days are skipped. The timings are appended to results_filename
+	(csv) and returned as a DataFrame"""
+
+	commit, timestamp = return_commit(), time.strftime("%Y-%m-%d %H:%M:%S")
+	folder = data_dir if data_dir is not None else tempfile.mkdtemp(prefix="inods_benchmark")
+	if not os.path.isdir(folder): os.makedirs(folder)
+	table = []
+	try:
+		for n_nodes in nodes:
+			for n_times in timesteps:
+				if n_nodes*n_times > max_node_days:
+					print ("skipping"), n_nodes, ("nodes x"), n_times, ("timesteps (more than max_node_days)")
+					continue
+				for infection_type in infection_types:
+					for lag in lags:
+						name = "%s_%d_%d_%s" % (infection_type, n_nodes, n_times, "nolag" if lag is None else "lag%g" % lag)
+						edge_filename, health_filename = os.path.join(folder, name + "_edges.csv"), os.path.join(folder, name + "_health.csv")
+						start = time.time()
+						n_edges, n_infected = sd.generate_dataset(n_nodes, n_times, infection_type, edge_filename, health_filename, diagnosis_lag=lag, mean_degree=mean_degree, seed=seed)
+						print ("generated"), name, ("edges ="), n_edges, ("infected nodes ="), n_infected, ("in"), round(time.time()-start, 2), ("s")
+						timing, nsick_param = benchmark_dataset(edge_filename, health_filename, infection_type, lag is not None, repeat, likelihood_calls, null_networks, seed)
+						for stage in sorted(timing, key=lambda stage: stage_order.index(stage)):
+							calls, median, minimum = timing[stage]
+							print ("    %-24s %12.6f s" % (stage, median))
+							table.append({'timestamp': timestamp, 'commit': commit, 'nodes': n_nodes, 'timesteps': n_times, 'infection_type': infection_type,
+								'diagnosis_lag': lag is not None, 'edges': n_edges, 'infected': n_infected, 'sick_cases': nsick_param, 'stage': stage,
+								'calls': calls, 'seconds': median, 'min_seconds': minimum, 'repeat': repeat})
+	finally:
+		if data_dir is None: shutil.rmtree(folder)
+
+	df = pd.DataFrame(table, columns=result_columns)
+	df.to_csv(results_filename, mode="a", index=False, header=not os.path.isfile(results_filename))
+	return df
+
+##############################################################################
+def compare_results(results_filename, threshold=1.2):
+	r"""Compares the latest run in results_filename with the previous run of each dataset
+	and stage. Returns (and prints) the stages whose minimum time per call grew by more
+	than threshold times"""
+
+	df = pd.read_csv(results_filename)
+	key = ['nodes', 'timesteps', 'infection_type', 'diagnosis_lag', 'stage']
+	latest = df[df['timestamp'] == df['timestamp'].max()]
+	previous = df[df['timestamp'] < df['timestamp'].max()].groupby(key).last().reset_index()
+	merged = latest.merge(previous, on=key, suffixes=('', '_previous'))
+	merged['ratio'] = merged['min_seconds']/merged['min_seconds_previous']
+	slower = merged[merged['ratio'] > threshold][key + ['commit_previous', 'commit', 'min_seconds_previous', 'min_seconds', 'ratio']]
+	if len(merged) == 0: print ("no previous run to compare with")
+	elif len(slower) == 0: print ("no stage slower than"), threshold, ("times the previous run")
+	else:
+		print ("stages slower than"), threshold, ("times the previous run:")
+		print (slower.to_string(index=False))
+	return slower
+
+######################################################################33
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Scaling benchmarks of INoDS on synthetic data")
+	parser.add_argument("--nodes", type=int, nargs="+", default=[100, 1000, 10000])
+	parser.add_argument("--timesteps", type=int, nargs="+", default=[10, 100, 1000])
+	parser.add_argument("--types", nargs="+", default=["SI", "SIR", "SIS"], help="infection types")
+	parser.add_argument("--lag", type=float, nargs="+", default=[0, 2], help="mean diagnosis lags (0 = no diagnosis lag)")
+	parser.add_argument("--degree", type=float, default=4., help="mean degree of the networks")
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--likelihood-calls", type=int, default=20)
+	parser.add_argument("--null-networks", type=int, default=10)
+	parser.add_argument("--max-node-days", type=float, default=1e7, help="skip datasets with more node-days")
+	parser.add_argument("--data-dir", default=None, help="keep the generated datasets in this directory")
+	parser.add_argument("--results", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.csv"))
+	parser.add_argument("--threshold", type=float, default=1.2, help="report stages slower than threshold times the previous run")
+	args = parser.parse_args()
+
+	run_benchmarks(args.nodes, args.timesteps, args.types, [lag if lag > 0 else None for lag in args.lag], args.results, args.repeat,
+		args.likelihood_calls, args.null_networks, args.degree, args.max_node_days, args.data_dir)
+	compare_results(args.results, args.threshold)
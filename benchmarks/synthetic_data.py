@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+##################################################
+## Synthetic dynamic networks and outbreaks in the INoDS input format
+## (see examples/Edge_connections_poisson.csv and examples/Health_data_nolag.csv)
+##################################################
+
+##############################################################################
+def generate_dynamic_network(n_nodes, n_times, mean_degree=4., turnover=0.2, weighted=False, seed=None):
+	r"""Dynamic Poisson (Erdos-Renyi) network. The network of the first timestep has
+	n_nodes*mean_degree/2 random edges, and at every later timestep a fraction turnover
+	of the edges is replaced by new random edges. Returns the edge list as a DataFrame
+	with columns node1, node2, weight, timestep"""
+
+	rng = np.random.RandomState(seed)
+	n_edges = max(int(round(n_nodes*mean_degree/2.)), 1)
+
+	def random_edges(size):
+		node1 = rng.randint(n_nodes, size=size)
+		##never a self loop
+		return node1, (node1 + rng.randint(1, n_nodes, size=size)) % n_nodes
+
+	node1, node2 = random_edges(n_edges)
+	weight = rng.uniform(0.1, 2, size=n_edges) if weighted else np.ones(n_edges)
+	edge_list = []
+	for time1 in xrange(n_times):
+		if time1 > 0:
+			replaced = rng.rand(n_edges) < turnover
+			node1, node2 = node1.copy(), node2.copy()
+			node1[replaced], node2[replaced] = random_edges(replaced.sum())
+			if weighted:
+				weight = weight.copy()
+				weight[replaced] = rng.uniform(0.1, 2, size=replaced.sum())
+		edge_list.append(pd.DataFrame({'node1': node1, 'node2': node2, 'weight': weight, 'timestep': time1}))
+
+	return pd.concat(edge_list, ignore_index=True)[['node1', 'node2', 'weight', 'timestep']]
+
+##############################################################################
+def simulate_outbreak(edges, n_nodes, n_times, infection_type, beta=0.1, epsilon=0.001, gamma=0.05, seed_fraction=0.01, report_prob=0.5, diagnosis_lag=None, seed=None):
+	r"""Discrete time SI/SIR/SIS outbreak on the dynamic network edges (see
+	generate_dynamic_network), with the INoDS force of infection: a susceptible node is
+	infected at timestep t with probability 1-exp(-(beta*infected strength at t-1 + epsilon)).
+	Infected nodes recover with probability gamma per timestep (SIR: removed, SIS:
+	susceptible again). Each node is tested on a timestep with probability report_prob,
+	and all nodes are tested at timestep 0, when the seed infections are diagnosed (so every
+	later sick period follows a report, as the diagnosis lag model requires). If 
+	diagnosis_lag (mean number of timesteps) is given, later infections are only diagnosed
+	after a geometric delay, and tests before that report the node as healthy. Returns
+	the health reports as a DataFrame with columns node, timestep, diagnosis and the
+	(nodes x timesteps) matrix of infection states (0 = susceptible, 1 = infected,
+	2 = recovered)"""
+
+	infection_type = infection_type.upper()
+	rng = np.random.RandomState(seed)
+	state = np.zeros((n_nodes, n_times), dtype=np.int8)
+	current = np.zeros(n_nodes, dtype=np.int8)
+	current[rng.choice(n_nodes, max(int(seed_fraction*n_nodes), 1), replace=False)] = 1
+	diagnosed_day = np.full(n_nodes, n_times, dtype=int)
+	if diagnosis_lag: delay = rng.geometric(1./(1 + diagnosis_lag), size=n_nodes) - 1
+	else: delay = np.zeros(n_nodes, dtype=int)
+	diagnosed_day[current == 1] = 0
+
+	edge_time = edges['timestep'].values
+	edge_start = np.searchsorted(edge_time, np.arange(n_times + 1))
+	node1, node2, weight = edges['node1'].values, edges['node2'].values, edges['weight'].values.astype(float)
+	for time1 in xrange(n_times):
+		state[:, time1] = current
+		if time1 == n_times - 1: break
+		##infected strength of each node at time1
+		sl = slice(edge_start[time1], edge_start[time1+1])
+		infected = (current == 1).astype(float)
+		strength = np.bincount(node1[sl], weights=weight[sl]*infected[node2[sl]], minlength=n_nodes)
+		strength += np.bincount(node2[sl], weights=weight[sl]*infected[node1[sl]], minlength=n_nodes)
+		new = current.copy()
+		infection = (current == 0) & (rng.rand(n_nodes) < 1 - np.exp(-(beta*strength + epsilon)))
+		recovery = (current == 1) & (rng.rand(n_nodes) < gamma) if infection_type != "SI" else np.zeros(n_nodes, dtype=bool)
+		new[infection] = 1
+		new[recovery] = 2 if infection_type == "SIR" else 0
+		##a new infection (also a reinfection in SIS) is diagnosed after its own delay
+		diagnosed_day[infection] = time1 + 1 + delay[infection]
+		current = new
+
+	##tested node-days, recovered nodes are reported healthy
+	tested = rng.rand(n_nodes, n_times) < report_prob
+	tested[:, 0] = True
+	node, timestep = np.nonzero(tested)
+	diagnosis = (state[node, timestep] == 1) & (timestep >= diagnosed_day[node])
+	reports = pd.DataFrame({'node': node, 'timestep': timestep, 'diagnosis': diagnosis.astype(int)})
+
+	return reports[['node', 'timestep', 'diagnosis']], state
+
+##############################################################################
+def write_input_files(edges, reports, edge_filename, health_filename):
+	r"""Writes the edge list and health reports with the headers of the example files"""
+
+	edges.to_csv(edge_filename, index=False)
+	reports.rename(columns={'node': 'Node', 'timestep': 'time_step'}).to_csv(health_filename, index=False)
+
+##############################################################################
+def generate_dataset(n_nodes, n_times, infection_type, edge_filename, health_filename, diagnosis_lag=None, mean_degree=4., seed=None, **kwargs):
+	r"""Generates a dynamic network and an outbreak on it (see generate_dynamic_network and
+	simulate_outbreak, kwargs are passed to simulate_outbreak) and writes them to
+	edge_filename and health_filename. Returns the number of edges and of infected nodes"""
+
+	rng = np.random.RandomState(seed)
+	edges = generate_dynamic_network(n_nodes, n_times, mean_degree=mean_degree, seed=rng.randint(2**31-1))
+	reports, state = simulate_outbreak(edges, n_nodes, n_times, infection_type, diagnosis_lag=diagnosis_lag, seed=rng.randint(2**31-1), **kwargs)
+	write_input_files(edges, reports, edge_filename, health_filename)
+	return len(edges), int((state == 1).any(axis=1).sum())